@@ -0,0 +1,57 @@
+"""Benchmark throughput of the ideas listing with and without logging every SQL statement (SQLALCHEMY_ECHO).
+
+Run against a database filled by seed_database.py:
+
+    python3 benchmarks/engine_echo.py
+
+Requests are sent by as many threads as a gunicorn worker runs, so they share the connection pool.
+Logged statements are written to a file, as flask.log is written in production.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+REQUESTS = 400
+THREADS = int(os.environ.get('GUNICORN_THREADS', 4))
+URLS = ["/all-ideas?sort=votes&perpage=20&page=1", "/all-ideas?search=app&sort=relevance&perpage=20&page=1"]
+
+
+def get(app, url):
+    with app.test_client() as client:
+        result = client.get(url)
+        assert result.status_code == 200, result.status
+        return result.data
+
+
+def run(echo):
+    app = server.create_app({"SQLALCHEMY_ECHO": echo})
+    with app.app_context():
+        # the first requests load templates and open connections
+        for url in URLS:
+            get(app, url)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(THREADS) as executor:
+            list(executor.map(get, [app] * REQUESTS, URLS * (REQUESTS // len(URLS))))
+        seconds = time.perf_counter() - start
+
+        server.db.engine.dispose()
+
+    print(f"echo {'on' if echo else 'off'}: {REQUESTS / seconds:.0f} requests/s")
+
+
+if __name__ == "__main__":
+    with tempfile.NamedTemporaryFile("w", suffix=".log") as log:
+        # with a handler of its own, the engine logger doesn't print to stdout
+        logging.getLogger("sqlalchemy.engine.Engine").addHandler(logging.StreamHandler(log))
+        run(echo=True)
+    run(echo=False)
@@ -0,0 +1,68 @@
+"""Benchmark startup time and memory of gunicorn workers with and without preloading the app.
+
+    python3 benchmarks/gunicorn_startup.py
+
+Memory of a worker is its proportional set size (PSS): memory shared with the master 
+and other workers is divided between them, so preloaded modules count once for all processes.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BIND = "127.0.0.1:5099"
+METRICS_TOKEN = "benchmark"
+WORKERS = 4
+
+
+def pss_kb(pid):
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1])
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def run(preload):
+    env = dict(os.environ, GUNICORN_BIND=BIND, GUNICORN_WORKERS=str(WORKERS), GUNICORN_PRELOAD=preload, 
+               METRICS_TOKEN=METRICS_TOKEN)
+    start = time.perf_counter()
+    master = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        # started when every worker has answered a request
+        pids = set()
+        while len(pids) < WORKERS:
+            try:
+                metrics = urllib.request.Request(f"http://{BIND}/metrics", headers={"Authorization": f"Bearer {METRICS_TOKEN}"})
+                with urllib.request.urlopen(metrics) as response:
+                    pids.add(json.load(response)["requests"]["pid"])
+            except OSError:
+                time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        workers = children(master.pid)
+        worker_kb = sum(pss_kb(pid) for pid in workers) / len(workers)
+        total_kb = pss_kb(master.pid) + sum(pss_kb(pid) for pid in workers)
+    finally:
+        master.terminate()
+        master.wait()
+
+    print(f"preload={preload}: all {WORKERS} workers answering in {elapsed:.2f}s, "
+          f"{worker_kb / 1024:.1f} MB per worker, {total_kb / 1024:.1f} MB with the master")
+
+
+if __name__ == "__main__":
+    for preload in ("false", "true"):
+        run(preload)
@@ -0,0 +1,45 @@
+"""Benchmark the cost of importing the server module, creating the app and serving its first request.
+
+    python3 benchmarks/import_time.py
+
+Every measurement runs in a fresh interpreter, so nothing is already imported.
+No secrets are set: importing the server and creating the app must not need them.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+
+MEASURE = """
+import json
+import time
+
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+app = server.create_app()
+created = time.perf_counter()
+app.test_client().get("/static/css/style.css")
+served = time.perf_counter()
+
+print(json.dumps({"import": imported - start, "create_app": created - imported, "first request": served - created}))
+"""
+
+
+def measure():
+    env = {"PATH": os.environ.get("PATH", ""), "DATABASE_URL": "postgresql:///ideas"}
+    output = subprocess.run([sys.executable, "-c", MEASURE], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+if __name__ == "__main__":
+    runs = [measure() for _ in range(RUNS)]
+    for step in runs[0]:
+        best = min(run[step] for run in runs)
+        print(f"{step}: {best * 1000:.0f} ms")
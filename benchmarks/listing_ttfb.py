@@ -0,0 +1,67 @@
+"""Benchmark time to first byte of the ideas listing, streamed vs rendered at once.
+
+Run against a database filled by seed_database.py:
+
+    python3 benchmarks/listing_ttfb.py
+
+A page rendered at once sends its first byte when the whole page is ready, 
+so its time to first byte is the time of the whole response.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template, Response
+
+import server
+
+
+REQUESTS = 50
+URL = "/all-ideas?search=app&sort=relevance&perpage=50&page=1"
+
+
+def measure(client):
+    """Return seconds to the first chunk and to the whole body of the response."""
+
+    start = time.perf_counter()
+    result = client.get(URL)
+    assert result.status_code == 200, result.status
+    chunks = iter(result.response)
+    next(chunks)
+    first_byte = time.perf_counter() - start
+    for chunk in chunks:
+        pass
+    result.close()
+
+    return first_byte, time.perf_counter() - start
+
+
+def rendered_at_once(template_name, **context):
+    # what the listing routes did before streaming: run the query, then render the whole page
+    context["ideas"] = context["ideas"]._fetch(*context["ideas"]._args)
+
+    return Response(render_template(template_name, **context))
+
+
+def run(app, name):
+    client = app.test_client()
+    # the first request loads templates and connects to the database
+    measure(client)
+
+    first_bytes, totals = zip(*[measure(client) for n in range(REQUESTS)])
+    print(f"{name}: time to first byte {sum(first_bytes) / REQUESTS * 1000:.1f} ms, "
+          f"whole page {sum(totals) / REQUESTS * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    app = server.create_app()
+
+    stream_template = server.stream_template
+    server.stream_template = rendered_at_once
+    run(app, "rendered at once")
+
+    server.stream_template = stream_template
+    run(app, "streamed")
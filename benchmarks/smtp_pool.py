@@ -0,0 +1,47 @@
+"""Benchmark sending notification emails with a new SMTP connection per email vs pooled connections.
+
+Start a local SMTP server and run the benchmark against it:
+
+    python3 -m aiosmtpd -n -l localhost:8025
+    SMTP_SERVER=localhost SMTP_PORT=8025 SMTP_USE_SSL=false NOTIFICATION_PASSWORD="" python3 benchmarks/smtp_pool.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+EMAILS = 200
+BATCH_SIZE = 50
+
+
+def email(n):
+    return (f"Comment {n}", f"<p>Comment {n}</p>", "LightBulb notification", f"user{n}@test.com")
+
+
+def send_with_new_connections():
+    for n in range(EMAILS):
+        # a new pool for every email behaves like connecting and logging in for every email
+        utils.smtp_pool = utils.SMTPConnectionPool()
+        utils.send_email(*email(n))
+        utils.smtp_pool.close()
+
+
+def send_with_pool():
+    utils.smtp_pool = utils.SMTPConnectionPool()
+    for start in range(0, EMAILS, BATCH_SIZE):
+        errors = utils.send_emails([email(n) for n in range(start, start + BATCH_SIZE)])
+        assert not any(errors), errors
+    utils.smtp_pool.close()
+
+
+if __name__ == "__main__":
+    for send in (send_with_new_connections, send_with_pool):
+        start = time.perf_counter()
+        send()
+        elapsed = time.perf_counter() - start
+        print(f"{send.__name__}: {EMAILS} emails in {elapsed:.2f}s ({EMAILS / elapsed:.0f} emails/s)")
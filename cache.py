@@ -0,0 +1,187 @@
+"""Caches of search result pages, signed in users and rendered parts of pages.
+
+Search results are kept in the server process or shared by all server processes in Redis, 
+signed in users are cached only in Redis, rendered parts of pages are always kept in the process, 
+they are cheaper to render again than to get from Redis."""
+
+from collections import OrderedDict
+import threading
+import time
+import json
+import os
+
+
+# redis://host:port/db to share the cache between server processes, empty to keep it in every process
+cache_url = os.environ.get('SEARCH_CACHE_URL', '')
+# number of entries kept in the process, the least recently used entry is dropped first
+max_entries = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+# seconds an entry is kept, 0 to turn the cache off
+ttl = int(os.environ.get('SEARCH_CACHE_TTL', 300))
+
+# seconds a user is kept in Redis with SEARCH_CACHE_URL, 0 to turn the cache off
+user_ttl = int(os.environ.get('USER_CACHE_TTL', 300))
+
+# number of rendered idea rows and comments kept in the process
+fragment_max_entries = int(os.environ.get('FRAGMENT_CACHE_SIZE', 5000))
+# seconds a rendered fragment is kept, 0 to turn the cache off
+fragment_ttl = int(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+
+
+class MemoryCache:
+    """LRU cache with expiring entries in the server process."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for the key or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store the value for ttl seconds."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generation(self, name):
+        """Return the current generation of the named group of entries."""
+
+        with self._lock:
+            return self._generations.get(name, 0)
+
+    def bump(self, name):
+        """Start a new generation of the named group, so its old entries are never read again."""
+
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisCache:
+    """Cache in Redis shared by all server processes. 
+    Least recently used entries are dropped by Redis when maxmemory-policy is allkeys-lru."""
+
+    def __init__(self, url, ttl, prefix="lightbulb:"):
+        # redis is only needed if the cache is shared
+        import redis
+
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def generation(self, name):
+        return int(self._redis.get(f"{self.prefix}generation:{name}") or 0)
+
+    def bump(self, name):
+        self._redis.incr(f"{self.prefix}generation:{name}")
+
+    def size(self):
+        return None
+
+
+class Cache:
+    """Cache with hit and miss counters of the process. 
+
+    Entries are grouped in generations: the key of an entry contains the generations it depends on, 
+    and a change of the data bumps the generation instead of looking for the entries it affects."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.enabled = backend.ttl > 0
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def get(self, key):
+        """Return the value stored for the key or None, 
+        a cache that can't be reached works as an empty one."""
+
+        if not self.enabled:
+            return None
+
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            self._count("errors")
+            return None
+
+        self._count("misses" if value is None else "hits")
+
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+
+        try:
+            self.backend.set(key, value)
+        except Exception:
+            self._count("errors")
+
+    def key(self, *parts, generations=()):
+        """Return key of the entry made of parts and current generations of the named groups."""
+
+        try:
+            parts = [f"{name}{self.backend.generation(name)}" for name in generations] + list(parts)
+        except Exception:
+            self._count("errors")
+            return None
+
+        return ":".join(str(part) for part in parts)
+
+    def bump(self, name):
+        try:
+            self.backend.bump(name)
+        except Exception:
+            self._count("errors")
+
+    def get_metrics(self):
+        """Return number of hits, misses and errors of this process and number of cached entries."""
+
+        with self._lock:
+            metrics = dict(self._metrics)
+
+        metrics["size"] = self.backend.size()
+        metrics["hit_ratio"] = metrics["hits"] / (metrics["hits"] + metrics["misses"]) if metrics["hits"] + metrics["misses"] else 0.0
+
+        return metrics
+
+
+search_cache = Cache(RedisCache(cache_url, ttl) if cache_url else MemoryCache(max_entries, ttl))
+fragment_cache = Cache(MemoryCache(fragment_max_entries, fragment_ttl))
+# a change of a user bumps the generation only in the process that made it, so without Redis 
+# other processes would keep the old user, the user is then loaded once per request
+user_cache = Cache(RedisCache(cache_url, user_ttl) if cache_url else MemoryCache(0, 0))
@@ -1,7 +1,295 @@
 """CRUD operations."""
 
-from model import db, User, Idea, Vote, Comment, connect_to_db
-from sqlalchemy import func, case, or_
+from model import db, User, Idea, Vote, Comment, SearchIndexQueue, connect_to_db, read_from_primary
+from sqlalchemy import func, case, or_, tuple_, literal, true
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from flask_sqlalchemy import Pagination
+import fulltext
+from cache import search_cache
+from datetime import datetime
+from collections import namedtuple
+import base64
+import json
+
+
+# an idea on the listing page with its total votes and 1/0 if the logged in user voted for it
+IdeaWithVotes = namedtuple("IdeaWithVotes", ["idea", "total_votes", "user_vote"])
+
+
+class KeysetPage:
+    """A page of ideas fetched with a cursor instead of an offset.
+    Unlike Pagination it doesn't count all ideas, so pages is None."""
+
+    pages = None
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+
+
+class DeferredPage:
+    """A page of ideas that is fetched when a template uses it for the first time, 
+    so a streamed page sends everything above the list of ideas before the listing query runs."""
+
+    def __init__(self, fetch, *args):
+        self._fetch = fetch
+        self._args = args
+        self._page = None
+
+    def __getattr__(self, name):
+        if self._page is None:
+            self._page = self._fetch(*self._args)
+
+        return getattr(self._page, name)
+
+
+def get_sort_keys(sort):
+    """Return the columns ideas are ordered by (all descending) for the sort value."""
+
+    if sort == "votes":
+        return [Idea.vote_count, Idea.modified, Idea.idea_id]
+
+    return [Idea.modified, Idea.idea_id]
+
+
+def encode_cursor(idea, sort, direction):
+    """Return an opaque cursor pointing before ("prev") or after ("next") the idea."""
+
+    values = []
+    for key in get_sort_keys(sort):
+        value = getattr(idea, key.key)
+        values.append(value.isoformat() if isinstance(value, datetime) else value)
+
+    cursor = json.dumps([direction, values], separators=(",", ":"))
+
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    """Return the direction and the sort key values stored in the cursor."""
+
+    try:
+        direction, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        keys = get_sort_keys(sort)
+        if direction not in ("next", "prev") or len(values) != len(keys):
+            raise ValueError
+
+        values = [datetime.fromisoformat(value) if key is Idea.modified else int(value)
+                  for key, value in zip(keys, values)]
+    except (ValueError, TypeError):
+        raise ValueError("The page link is invalid. Try again.")
+
+    return direction, values
+
+
+def validate_cursor(cursor, sort):
+    """Raise ValueError if the page would be looked for by a cursor that is invalid."""
+
+    if cursor and sort != "relevance":
+        decode_cursor(cursor, sort)
+
+
+def paginate_by_cursor(ideas_with_votes, sort, cursor, perpage):
+    """Return a KeysetPage of ideas after or before the cursor, an empty cursor means the first page.
+    Seeks to the cursor by the sort columns instead of skipping rows with OFFSET, 
+    so deep pages cost the same as the first one."""
+
+    keys = get_sort_keys(sort)
+    direction = "next"
+
+    if cursor:
+        direction, values = decode_cursor(cursor, sort)
+        if direction == "next":
+            ideas_with_votes = ideas_with_votes.filter(tuple_(*keys) < tuple_(*values))
+        else:
+            ideas_with_votes = ideas_with_votes.filter(tuple_(*keys) > tuple_(*values))
+
+    if direction == "next":
+        ideas_with_votes = ideas_with_votes.order_by(*[key.desc() for key in keys])
+    else:
+        ideas_with_votes = ideas_with_votes.order_by(*[key.asc() for key in keys])
+
+    # fetch one extra row to find out if there is a page after this one
+    items = ideas_with_votes.limit(perpage + 1).all()
+    has_more = len(items) > perpage
+    items = items[:perpage]
+
+    if direction == "prev":
+        items.reverse()
+
+    next_cursor = None
+    prev_cursor = None
+    if items:
+        if direction == "prev" or has_more:
+            next_cursor = encode_cursor(items[-1][0], sort, "next")
+        if (direction == "next" and cursor) or (direction == "prev" and has_more):
+            prev_cursor = encode_cursor(items[0][0], sort, "prev")
+
+    return KeysetPage(items, next_cursor, prev_cursor)
+
+
+def get_comments_page(idea_id, cursor, perpage):
+    """Return a KeysetPage of comments to an idea, latest first, that come after the cursor, 
+    an empty cursor means the first page. Comments can only be paged forward, so prev_cursor is None."""
+
+    after = None
+    if cursor:
+        try:
+            modified, comment_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            after = (datetime.fromisoformat(modified), int(comment_id))
+        except (ValueError, TypeError):
+            raise ValueError("The page link is invalid. Try again.")
+
+    # fetch one extra comment to find out if there is a page after this one
+    comments = Comment.get_page_by_idea_id(idea_id, after, perpage + 1)
+
+    next_cursor = None
+    if len(comments) > perpage:
+        comments = comments[:perpage]
+        last = json.dumps([comments[-1].modified.isoformat(), comments[-1].comment_id], separators=(",", ":"))
+        next_cursor = base64.urlsafe_b64encode(last.encode()).decode()
+
+    return KeysetPage(comments, next_cursor, None)
+
+
+def paginate(ideas_with_votes, sort, page, perpage, cursor, search_query=None):
+    """Return the page of ideas sorted according to sort value, 
+    the page is found by cursor or, if cursor is None, by page number.
+    Search results sorted by relevance are always found by page number."""
+
+    if cursor is not None and sort != "relevance":
+        return paginate_by_cursor(ideas_with_votes, sort, cursor, perpage)
+
+    if sort == "relevance" and search_query is not None:
+        # only the ideas on the page are fetched, idea_id keeps the order of ideas with equal score the same on every page
+        ideas_with_votes = ideas_with_votes.order_by(
+            fulltext.score(Idea.search_vector, search_query, Idea.vote_count, Idea.modified).desc(),
+            Idea.idea_id.desc()
+            )
+    elif sort == "votes":
+        ideas_with_votes = ideas_with_votes.order_by(
+            Idea.vote_count.desc(), 
+            Idea.modified.desc(),
+            Idea.idea_id.desc()
+            )
+    else:
+        ideas_with_votes = ideas_with_votes.order_by(Idea.modified.desc(), Idea.idea_id.desc())
+
+    return ideas_with_votes.paginate(page, perpage, error_out = False)
+
+
+def filter_by_search(ideas_with_votes, search):
+    """Return ideas whose title or description contain all words from search, and the search query."""
+
+    search_query = fulltext.query(search)
+    if search_query is not None:
+        ideas_with_votes = ideas_with_votes.filter(Idea.search_vector.op("@@")(search_query))
+
+    return ideas_with_votes, search_query
+
+
+def add_user_votes(ideas_with_votes, loged_user_id):
+    """Add to every idea on the page whether the logged in user voted for it.
+    Looks up only the ideas on the page, so the cost doesn't grow with the number of votes."""
+
+    voted_idea_ids = set()
+    if loged_user_id is not None and ideas_with_votes.items:
+        voted_idea_ids = Vote.get_voted_idea_ids(
+            loged_user_id, 
+            [idea.idea_id for idea, total_votes in ideas_with_votes.items])
+
+    ideas_with_votes.items = [
+        IdeaWithVotes(idea, total_votes, int(idea.idea_id in voted_idea_ids))
+        for idea, total_votes in ideas_with_votes.items]
+
+    return ideas_with_votes
+
+
+def get_search_cache_key(search, sort, page, perpage, cursor):
+    """Return cache key of the page of all ideas matching search, or None if there is nothing to search for.
+    The key doesn't depend on the order and case of words, and contains version stamps of the ideas the page depends on:
+    every page depends on ideas and their searchable text, pages sorted by votes or relevance also depend on votes.
+    Stamps are read from the database, so a change made by any server process or worker is seen by all of them."""
+
+    words = fulltext.split_words(search)
+    if not words or not search_cache.enabled:
+        return None
+
+    modified, votes_modified, indexed, queued = get_ideas_version()
+    versions = (modified, votes_modified, indexed, queued) if sort in ("votes", "relevance") else (modified, indexed, queued)
+    position = f"page={page}" if cursor is None or sort == "relevance" else f"cursor={cursor}"
+
+    return search_cache.key("ideas", *versions, " ".join(sorted(set(words))), sort, position, perpage)
+
+
+def dump_page(ideas_with_votes):
+    """Return ids of ideas on the page and what else is needed to rebuild the page from them."""
+
+    entry = {"ids": [idea.idea_id for idea, total_votes in ideas_with_votes.items]}
+
+    if ideas_with_votes.pages is None:
+        entry["next_cursor"] = ideas_with_votes.next_cursor
+        entry["prev_cursor"] = ideas_with_votes.prev_cursor
+    else:
+        entry["page"] = ideas_with_votes.page
+        entry["per_page"] = ideas_with_votes.per_page
+        entry["total"] = ideas_with_votes.total
+
+    return entry
+
+
+def load_page(entry):
+    """Return the page of ideas with total votes rebuilt from the cache entry. 
+    Ideas are read by primary key, so they and their votes are up to date."""
+
+    ideas = {}
+    if entry["ids"]:
+        ideas = {idea.idea_id: idea for idea in Idea.query.filter(Idea.idea_id.in_(entry["ids"]))}
+    items = [(ideas[idea_id], ideas[idea_id].vote_count) for idea_id in entry["ids"] if idea_id in ideas]
+
+    if "total" in entry:
+        return Pagination(None, entry["page"], entry["per_page"], entry["total"], items)
+
+    return KeysetPage(items, entry["next_cursor"], entry["prev_cursor"])
+
+
+def get_ideas_version(user_id=None):
+    """Return version stamps of the listing of all ideas or of ideas created by user: 
+    when ideas and votes for them were last changed, when search text of an idea was last computed, 
+    and when an idea was last queued to update search results."""
+
+    versions = db.session.query(
+        func.max(Idea.modified), 
+        func.max(Idea.votes_modified),
+        func.max(Idea.search_indexed),
+        db.session.query(func.max(SearchIndexQueue.queued)).scalar_subquery()
+        )
+
+    if user_id is not None:
+        versions = versions.filter(Idea.user_id==user_id)
+
+    return tuple(versions.one())
+
+
+def get_idea_with_comments_version(idea_id):
+    """Return an idea with its author and version stamps of its comments, or None if there is no such idea. 
+
+    Stamps are when a comment was last changed, number of comments and a hash of names of their authors, 
+    a renamed author changes the page too. They are read in the query of the idea, so the stamps cost no extra query."""
+
+    versions = db.session.query(
+        func.max(Comment.modified), 
+        func.count(Comment.comment_id),
+        func.md5(func.string_agg(User.username, aggregate_order_by(literal(","), Comment.comment_id)))
+        ).join(User, Comment.user_id==User.user_id).filter(Comment.idea_id==idea_id).subquery()
+
+    row = db.session.query(Idea, versions).join(versions, true()).options(
+        db.joinedload(Idea.user)).filter(Idea.idea_id==idea_id).first()
+
+    return None if row is None else (row[0], tuple(row[1:]))
 
 
 def get_idea_votes(user_id, idea_id):
@@ -10,80 +298,56 @@ def get_idea_votes(user_id, idea_id):
     if user_id is None:
         idea_votes = db.session.query(
             Idea.idea_id, 
-            func.count(Vote.vote_id).label("total_votes")
-            ).outerjoin(Vote).filter(Idea.idea_id==idea_id).group_by(Idea.idea_id).first()
+            Idea.vote_count.label("total_votes")
+            ).filter(Idea.idea_id==idea_id).first()
 
 
     else:
+        user_voted = db.session.query(Vote.vote_id).filter(
+            Vote.user_id==user_id, 
+            Vote.idea_id==Idea.idea_id
+            ).exists()
+
         idea_votes = db.session.query(
             Idea.idea_id, 
             Idea.title, 
-            func.count(Vote.vote_id).label("total_votes"),
-            func.count(case(
-            [((Vote.user_id == user_id), 1)])).label("user_vote")
-            ).outerjoin(Vote).filter(Idea.idea_id==idea_id).group_by(Idea.idea_id).first()
+            Idea.vote_count.label("total_votes"),
+            case([(user_voted, 1)], else_=0).label("user_vote")
+            ).filter(Idea.idea_id==idea_id).first()
 
     return idea_votes
 
-def get_user_ideas_with_votes_filtered(user_id, loged_user_id, search, sort, page, perpage):
+def get_user_ideas_with_votes_filtered(user_id, loged_user_id, search, sort, page, perpage, cursor=None):
     """Return all user ideas with total votes and votes made by user on the page 
     whose title and description contain words from search and that are sorted according to sort value."""
 
-    if search == "":
-        ideas_with_votes = Idea.query.outerjoin(Vote)
-    else:
-        ideas_with_votes = Idea.query.msearch(search, fields=['title', 'description']).outerjoin(Vote)
+    ideas_with_votes, search_query = filter_by_search(Idea.query, search)
 
-    if loged_user_id is None:
-        ideas_with_votes = ideas_with_votes.add_columns(
-                    func.count(Vote.vote_id).label("total_votes")
-                    )
-    else:
-        ideas_with_votes = ideas_with_votes.add_columns(
-                    func.count(Vote.vote_id).label("total_votes"),
-                    func.count(case(
-                    [((Vote.user_id == loged_user_id), 1)])).label("user_vote")
-                    )
+    ideas_with_votes = ideas_with_votes.add_columns(
+                Idea.vote_count.label("total_votes")
+                )
 
-    ideas_with_votes = ideas_with_votes.group_by(Idea.idea_id).filter(Idea.user_id==user_id)
+    ideas_with_votes = ideas_with_votes.filter(Idea.user_id==user_id)
+    ideas_with_votes = paginate(ideas_with_votes, sort, page, perpage, cursor, search_query)
 
-    if sort == "latest":
-        ideas_with_votes = ideas_with_votes.order_by(Idea.modified.desc())
-    elif sort == "votes":
-        ideas_with_votes = ideas_with_votes.order_by(
-            func.count(Vote.vote_id).desc(), 
-            Idea.modified.desc()
-            )
-
-    return ideas_with_votes.paginate(page, perpage, error_out = False)
+    return add_user_votes(ideas_with_votes, loged_user_id)
     
 
-def get_voted_by_user_ideas_with_votes_filtered(loged_user_id, search, sort, page, perpage):
+def get_voted_by_user_ideas_with_votes_filtered(loged_user_id, search, sort, page, perpage, cursor=None):
     """Return all ideas user voted for with total votes on the page
     whose title and description contain words from search and that are sorted according to sort value."""
     
-    if search == "":
-        ideas_with_votes = Idea.query.outerjoin(Vote)
-    else:
-        ideas_with_votes = Idea.query.msearch(search, fields=['title', 'description']).outerjoin(Vote)
+    ideas_with_votes, search_query = filter_by_search(Idea.query, search)
 
     ideas_with_votes = ideas_with_votes.add_columns(
-                func.count(Vote.vote_id).label("total_votes"),
-                func.count(case(
-                [((Vote.user_id == loged_user_id), 1)])).label("user_vote")
-                ).group_by(Idea.idea_id).filter(
+                Idea.vote_count.label("total_votes")
+                ).filter(
                     Idea.idea_id.in_(
                         db.session.query(Vote.idea_id).filter(Vote.user_id==loged_user_id)))
 
-    if sort == "latest":
-        ideas_with_votes = ideas_with_votes.order_by(Idea.modified.desc())
-    elif sort == "votes":
-        ideas_with_votes = ideas_with_votes.order_by(
-            func.count(Vote.vote_id).desc(), 
-            Idea.modified.desc()
-            )
+    ideas_with_votes = paginate(ideas_with_votes, sort, page, perpage, cursor, search_query)
 
-    return ideas_with_votes.paginate(page, perpage, error_out = False)
+    return add_user_votes(ideas_with_votes, loged_user_id)
 
 
 def get_most_voted_user_idea(user_id):
@@ -92,47 +356,53 @@ def get_most_voted_user_idea(user_id):
     idea_with_votes = db.session.query(
         Idea.idea_id, 
         Idea.title, 
-        func.count(Vote.vote_id).label("total_votes")
-        ).outerjoin(Vote).filter(Idea.user_id==user_id).group_by(Idea.idea_id).order_by(func.count(Vote.vote_id).desc(), Idea.modified.desc()).first()
+        Idea.vote_count.label("total_votes")
+        ).filter(Idea.user_id==user_id).order_by(Idea.vote_count.desc(), Idea.modified.desc()).first()
 
 
     return idea_with_votes
 
-def get_ideas_with_votes_filtered(loged_user_id, search, sort, page, perpage):
+def get_ideas_with_votes_filtered(loged_user_id, search, sort, page, perpage, cursor=None):
     """Return all ideas with total votes and votes made by user on the page 
     whose title and description contain words from search and that are sorted according to sort value."""
 
-    if search == "":
-        ideas_with_votes = Idea.query.outerjoin(Vote)
-    else:
-        ideas_with_votes = Idea.query.msearch(search, fields=['title', 'description']).outerjoin(Vote)
+    # popular searches are cached, the listing without search is cheap enough
+    cache_key = get_search_cache_key(search, sort, page, perpage, cursor)
+    if cache_key is not None:
+        entry = search_cache.get(cache_key)
+        if entry is not None:
+            return add_user_votes(load_page(entry), loged_user_id)
+
+    # a page that is cached is read from the primary: a replica that hasn't got the change 
+    # that moved the version stamps of the key would cache old results as new ones
+    with read_from_primary(cache_key is not None):
+        ideas_with_votes, search_query = filter_by_search(Idea.query, search)
 
-    if loged_user_id is None:
-        ideas_with_votes = ideas_with_votes.add_columns(
-                    func.count(Vote.vote_id).label("total_votes")
-                    )
-    else:
         ideas_with_votes = ideas_with_votes.add_columns(
-                    func.count(Vote.vote_id).label("total_votes"),
-                    func.count(case(
-                    [((Vote.user_id == loged_user_id), 1)])).label("user_vote")
+                    Idea.vote_count.label("total_votes")
                     )
+        ideas_with_votes = paginate(ideas_with_votes, sort, page, perpage, cursor, search_query)
 
-    ideas_with_votes = ideas_with_votes.group_by(Idea.idea_id)
+    if cache_key is not None:
+        search_cache.set(cache_key, dump_page(ideas_with_votes))
 
-    if sort == "latest":
-        ideas_with_votes = ideas_with_votes.order_by(Idea.modified.desc())
-    elif sort == "votes":
-        ideas_with_votes = ideas_with_votes.order_by(
-            func.count(Vote.vote_id).desc(), 
-            Idea.modified.desc()
-            )
+    return add_user_votes(ideas_with_votes, loged_user_id)
 
-    return ideas_with_votes.paginate(page, perpage, error_out = False)
-    
+
+def reconcile_vote_counts():
+    """Rebuild the stored number of votes of every idea from the votes table."""
+
+    total_votes = db.session.query(
+        func.count(Vote.vote_id)
+        ).filter(Vote.idea_id==Idea.idea_id).scalar_subquery()
+
+    # pages showing votes of the ideas whose count was wrong get a new version
+    Idea.query.filter(Idea.vote_count != total_votes).update(
+        {Idea.vote_count: total_votes, Idea.votes_modified: datetime.now()}, synchronize_session=False)
+    db.session.commit()
 
 
 if __name__ == "__main__":
-    from server import app
+    from server import create_app
 
-    connect_to_db(app)
+    app = create_app({"SQLALCHEMY_ECHO": True})
@@ -0,0 +1,67 @@
+"""Full-text search of ideas with PostgreSQL text search."""
+
+import os
+import re
+from sqlalchemy import func, cast, Date, Float, REAL
+from sqlalchemy.dialects.postgresql import array, ARRAY
+
+
+# text search configuration: english stemming and stop words
+config = "english"
+
+# how much a matching word weighs depending on where it is: D, C, B (description), A (title)
+weights = [0.1, 0.2, 0.4, 1.0]
+# ts_rank normalization 1: divide the rank by 1 + log(number of words), so long descriptions don't win just by length
+normalization = 1
+
+# how much votes and recency raise the text score of an idea, 0 to rank by text only
+votes_weight = float(os.environ.get('SEARCH_VOTES_WEIGHT', 0.1))
+recency_weight = float(os.environ.get('SEARCH_RECENCY_WEIGHT', 0.1))
+# an idea loses half of its recency bonus every recency_half_life days
+recency_half_life = 30
+
+
+def document(title, description):
+    """Return tsvector of the text of an idea, words of the title weigh more (A) than words of the description (B)."""
+
+    return func.setweight(func.to_tsvector(config, func.coalesce(title, "")), "A").op("||")(
+        func.setweight(func.to_tsvector(config, func.coalesce(description, "")), "B"))
+
+
+def split_words(search):
+    """Return the words of search in lower case."""
+
+    return re.findall(r"[^\W_]+", search.lower())
+
+
+def query(search):
+    """Return tsquery that matches texts containing all words from search, 
+    a word also matches longer words it's the beginning of. Return None if search has no words."""
+
+    words = split_words(search)
+    if not words:
+        return None
+
+    return func.to_tsquery(config, " & ".join(f"{word}:*" for word in words))
+
+
+def rank(search_vector, search_query):
+    """Return how well the text matches the query, higher is better."""
+
+    return func.ts_rank(cast(array(weights), ARRAY(REAL)), search_vector, search_query, normalization)
+
+
+def score(search_vector, search_query, vote_count, modified):
+    """Return relevance of an idea to the query: its text rank raised a little for votes and recency.
+
+    text rank * (1 + votes_weight * ln(1 + votes) + recency_weight * 0.5 ^ (age in days / recency_half_life))
+
+    Age is counted in whole days from the current date, so the score, and the order of pages, 
+    doesn't change between requests during the day."""
+
+    age = cast(func.current_date() - cast(modified, Date), Float)
+
+    return rank(search_vector, search_query) * (
+        1 
+        + votes_weight * func.ln(1 + vote_count) 
+        + recency_weight * func.power(0.5, age / recency_half_life))
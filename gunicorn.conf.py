@@ -0,0 +1,33 @@
+"""Configuration of gunicorn serving the app in production, every setting can be changed with env variables."""
+
+import multiprocessing
+import os
+
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5000')
+# worker processes, each of them handles `threads` requests at the same time
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+# load the app once before forking workers: workers start faster and share memory of imported modules
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true') == 'true'
+# on restart workers finish requests they are handling for up to graceful_timeout seconds
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+# a worker that doesn't answer for timeout seconds is restarted
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# restart workers after that many requests (with some jitter), so memory leaks don't grow forever
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    """Don't share database connections opened by the master process with workers, 
+    every worker opens its own connections."""
+
+    from model import db
+    from wsgi import app
+
+    with app.app_context():
+        db.engine.dispose()
@@ -0,0 +1,79 @@
+"""Worker that sends emails queued in the outbox by the server."""
+
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import exc
+
+import model
+import server
+from utils import send_emails
+
+
+BATCH_SIZE = 50
+# seconds to wait for new emails when the outbox is empty
+POLL_INTERVAL = 5
+# after that many failed attempts the email is not tried anymore
+MAX_ATTEMPTS = 8
+
+
+def retry_delay(attempts):
+    """Return how long to wait before the next attempt, doubling after every failed attempt: 
+    1 min, 2 min, 4 min..."""
+
+    return timedelta(minutes=2 ** (attempts - 1))
+
+
+def send_pending_emails(batch_size=BATCH_SIZE):
+    """Send a batch of emails that are due and return how many emails were taken from the outbox."""
+
+    emails = model.OutboxEmail.get_pending(batch_size)
+
+    # the whole batch is sent over one SMTP connection
+    errors = send_emails([(email.text, email.html, email.subject, email.receiver_email) for email in emails])
+
+    for email, error in zip(emails, errors):
+        if error is None:
+            email.sent = datetime.now()
+        else:
+            email.attempts += 1
+            email.last_error = str(error)
+            if email.attempts < MAX_ATTEMPTS:
+                email.next_attempt = datetime.now() + retry_delay(email.attempts)
+            else:
+                email.next_attempt = None
+
+    model.db.session.commit()
+
+    return len(emails)
+
+
+def run():
+    """Send emails from the outbox until the worker is stopped."""
+
+    while True:
+        try:
+            # comments collected during the owners' notification windows become emails in the outbox
+            model.CommentNotification.queue_digests()
+            model.db.session.commit()
+
+            taken = send_pending_emails()
+        except exc.SQLAlchemyError as err:
+            model.db.session.rollback()
+            print("Cannot read the email outbox:", err)
+            taken = 0
+        except Exception as err:
+            # an unexpected error fails this batch only, the worker keeps sending
+            model.db.session.rollback()
+            print("Cannot send emails:", err)
+            taken = 0
+
+        # if the batch was full there are probably more emails waiting
+        if taken < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    app = server.create_app()
+
+    with app.app_context():
+        run()
@@ -0,0 +1,83 @@
+"""Script to bring the schema of an existing database up to date with model.py."""
+
+from datetime import datetime
+
+import model
+import server
+
+
+# Changes to existing tables, in the order they have to be applied.
+# New tables don't need a migration, they are created from model.py.
+# Every statement must be safe to run again (IF NOT EXISTS etc.), because a migration 
+# interrupted half way is applied from the beginning next time.
+# Indexes are built CONCURRENTLY, so the site keeps working while they are created.
+MIGRATIONS = [
+    ("0001_idea_vote_count", [
+        "ALTER TABLE ideas ADD COLUMN IF NOT EXISTS vote_count INTEGER NOT NULL DEFAULT 0",
+        """UPDATE ideas SET vote_count = (
+            SELECT count(votes.vote_id) FROM votes WHERE votes.idea_id = ideas.idea_id)""",
+    ]),
+    ("0002_lookup_and_sort_indexes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_user_id_modified ON ideas (user_id, modified DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_modified_idea_id ON ideas (modified DESC, idea_id DESC)",
+        """CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_vote_count_modified_idea_id 
+            ON ideas (vote_count DESC, modified DESC, idea_id DESC)""",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_votes_idea_id ON votes (idea_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_idea_id_modified ON comments (idea_id, modified DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_user_id_modified ON comments (user_id, modified DESC)",
+    ]),
+    ("0003_user_notification_window", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS notification_window INTEGER NOT NULL DEFAULT 10",
+    ]),
+    ("0004_idea_full_text_search", [
+        "ALTER TABLE ideas ADD COLUMN IF NOT EXISTS search_vector TSVECTOR",
+        """UPDATE ideas SET search_vector = 
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') || 
+            setweight(to_tsvector('english', coalesce(description, '')), 'B')""",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_search_vector ON ideas USING gin (search_vector)",
+    ]),
+    ("0005_idea_votes_modified", [
+        "ALTER TABLE ideas ADD COLUMN IF NOT EXISTS votes_modified TIMESTAMP",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_votes_modified ON ideas (votes_modified DESC)",
+    ]),
+    ("0006_idea_search_indexed", [
+        "ALTER TABLE ideas ADD COLUMN IF NOT EXISTS search_indexed TIMESTAMP",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ideas_search_indexed ON ideas (search_indexed DESC)",
+    ]),
+]
+
+
+def migrate():
+    """Create new tables and apply migrations that haven't been applied yet."""
+
+    model.db.create_all()
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with model.db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(
+            """CREATE TABLE IF NOT EXISTS schema_migrations (
+                version VARCHAR(100) PRIMARY KEY, 
+                applied TIMESTAMP NOT NULL)""")
+
+        applied = {version for version, in connection.exec_driver_sql("SELECT version FROM schema_migrations")}
+
+        for version, statements in MIGRATIONS:
+            if version in applied:
+                continue
+
+            print(f"Applying {version}")
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+
+            connection.exec_driver_sql(
+                "INSERT INTO schema_migrations (version, applied) VALUES (%s, %s)", 
+                (version, datetime.now()))
+
+
+if __name__ == "__main__":
+    # building indexes of a big table may take longer than statements of the app are allowed to
+    server.create_app({
+        "SQLALCHEMY_ECHO": True,
+        "SQLALCHEMY_ENGINE_OPTIONS": model.get_engine_options(connect_args={}),
+        })
+    migrate()
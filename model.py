@@ -1,26 +1,85 @@
-from datetime import datetime
-from flask import render_template, abort
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import UniqueConstraint
-import bcrypt
-from utils import send_email
-from random import randint
+from datetime import datetime, timedelta
+from itertools import groupby
+from collections import Counter
+from flask import render_template, abort, g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import UniqueConstraint, func, tuple_, event, inspect, update, delete, bindparam, text
+from sqlalchemy.orm import sessionmaker, make_transient_to_detached
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+import passwords
+import fulltext
+from cache import user_cache
+from random import randint, choice
 import json
-from flask_msearch import Search
-from whoosh.analysis import RegexTokenizer, Filter
-from whoosh.fields import TEXT
+import os
+from contextlib import contextmanager
 
-class CaseSensitivizer(Filter):
-    def __call__(self, tokens):
-        for t in tokens:
-            yield t
-            text = t.text.lower()
-            if text != t.text:
-                t.text = text
-                yield t
 
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica in read-only requests and writes to the primary.
 
-db = SQLAlchemy()
+    Replicas are the binds in SQLALCHEMY_BINDS named replica_<n>, one of them is picked for the whole session. 
+    A request is read-only when its view sets g.read_only. Once the session writes anything, 
+    it's marked in session.info["wrote"], so the server can keep the user on the primary for a while."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+        elif has_request_context() and g.get("read_only") and not self.info.get("read_from_primary"):
+            replica = self.get_replica()
+            if replica is not None:
+                return replica
+
+        return super().get_bind(mapper, clause)
+
+    def get_replica(self):
+        if "replica" not in self.info:
+            replicas = [bind for bind in self.app.config.get("SQLALCHEMY_BINDS") or () if bind.startswith("replica_")]
+            self.info["replica"] = db.get_engine(self.app, bind=choice(replicas)) if replicas else None
+
+        return self.info["replica"]
+
+
+@contextmanager
+def read_from_primary(enabled=True):
+    """Read from the primary inside the block even in a read-only request, e.g. data that is cached after it's read."""
+
+    if not enabled or db.session.info.get("read_from_primary"):
+        yield
+        return
+
+    db.session.info["read_from_primary"] = True
+    try:
+        yield
+    finally:
+        db.session.info.pop("read_from_primary", None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with RoutingSession as the session."""
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# connections kept open in every server process, and extra connections opened when they are all busy
+pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds to wait for a free connection before the request fails
+pool_timeout = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, before the server or a firewall drops it
+pool_recycle = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# check that a connection is alive before using it
+pool_pre_ping = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+# milliseconds a statement may run before Postgres cancels it, 0 for no limit
+statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+# how psycopg2 sends many rows at once: "values_only" batches inserts, "values_plus_batch" also updates and deletes
+executemany_mode = os.environ.get('DB_EXECUTEMANY_MODE', 'values_plus_batch')
+# wait until buffered votes are on disk before answering, 0 answers sooner but a crash of Postgres may lose the last votes
+vote_buffer_durable = os.environ.get('VOTE_BUFFER_DURABLE', '1') == '1'
 
 
 class User(db.Model):
@@ -39,6 +98,8 @@ class User(db.Model):
     email_confirmed = db.Column(db.Boolean, default=False)
     email_confirm_date = db.Column(db.DateTime)
     created = db.Column(db.DateTime)
+    # minutes to wait for more comments to user's idea before sending one email about all of them
+    notification_window = db.Column(db.Integer, nullable=False, default=10, server_default="10")
 
 
     def __repr__(self):
@@ -57,12 +118,12 @@ class User(db.Model):
     # a setter function
     @password.setter
     def password(self, password):
-        self.password_hash = bcrypt.hashpw(password, bcrypt.gensalt())
+        self.password_hash = passwords.hash_password(password)
 
     def verify_password(self, password):
         # Check hashed password. Using bcrypt, the salt is saved into the hash itself
 
-        return bcrypt.checkpw(password, self.password_hash)
+        return passwords.check_password(password, self.password_hash)
 
 
     @classmethod
@@ -86,6 +147,25 @@ class User(db.Model):
 
         return cls.query.get(user_id)
 
+    @classmethod
+    def get_cached(cls, user_id):
+        """Return a user by primary key from the user cache, loading and caching the user on a miss. 
+
+        A cached user is attached to the session without a query, columns that aren't cached are loaded when they are used."""
+
+        key = user_cache.key("user", user_id, generations=[f"user{user_id}"])
+        columns = user_cache.get(key) if key else None
+        if columns is None:
+            user = cls.get_by_id(user_id)
+            if user is not None and key:
+                user_cache.set(key, {column: getattr(user, column) for column in CACHED_USER_COLUMNS})
+            return user
+
+        user = cls(**columns)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
     @classmethod
     def get_by_email(cls, email):
         """Return a user by email."""
@@ -108,7 +188,7 @@ class User(db.Model):
         return cls(email=email, username=username, password='', google_sign_only=True)
     
     @classmethod
-    def update_details(cls, user_id, username, description):
+    def update_details(cls, user_id, username, description, notification_window=None):
         """Update user deatils and return the user."""
 
         user = cls.get_by_id(user_id)
@@ -119,6 +199,11 @@ class User(db.Model):
         user.username = username
         user.description = description
 
+        if notification_window is not None:
+            if not isinstance(notification_window, int) or notification_window < 0:
+                raise ValueError("Wrong notification frequency. Try again.")
+            user.notification_window = notification_window
+
         return user
 
     @classmethod
@@ -158,22 +243,37 @@ class User(db.Model):
         user.email_confirmed_on = datetime.now()
 
 
+# columns of users kept in the user cache, the password hash is never cached
+CACHED_USER_COLUMNS = ["user_id", "username", "email", "description", "google_sign_only", "email_confirmed", "notification_window"]
+
+@event.listens_for(User, "after_update")
+def invalidate_cached_user(mapper, connection, user):
+    invalidate_after_commit(f"user{user.user_id}", user_cache)
+
+
+class UserSession(db.Model):
+    """A session of a browser, the cookie holds only its random id (see sessions.py)."""
+
+    __tablename__ = "user_sessions"
+
+    # hash of the id in the cookie, so the table can't be used to sign in
+    session_id = db.Column(db.String(64), primary_key=True)
+    # signed in user, to sign the user out in all browsers
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"))
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<UserSession user_id={self.user_id} expires={self.expires}>"
+
+db.Index("ix_user_sessions_user_id", UserSession.user_id)
+db.Index("ix_user_sessions_expires", UserSession.expires)
+
+
 class Idea(db.Model):
     """An idea."""
     
     __tablename__ = "ideas"
-    __searchable__ = ["title", "description"]
-    __msearch_schema__ = {
-                "title": TEXT(
-                    stored=True,
-                    analyzer=RegexTokenizer() | CaseSensitivizer(),
-                    sortable=False),
-                "description": TEXT(
-                    stored=True,
-                    analyzer=RegexTokenizer() | CaseSensitivizer(),
-                    sortable=False,
-                )
-            }
 
     idea_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -181,6 +281,16 @@ class Idea(db.Model):
     image = db.Column(db.String(2100))
     link = db.Column(db.String(2100))
     modified = db.Column(db.DateTime)
+    # number of votes for the idea, kept in sync with the votes table
+    # by the vote handlers so listings don't have to count votes
+    vote_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    # when votes for the idea were last added or removed, pages showing votes use it as their version
+    votes_modified = db.Column(db.DateTime)
+    # words of title and description for full-text search, see fulltext.py,
+    # only used in queries, so it's not loaded with the idea
+    search_vector = db.deferred(db.Column(TSVECTOR))
+    # when search_vector was last computed, search results use it as their version
+    search_indexed = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"))
 
     user = db.relationship("User", backref="ideas")
@@ -232,6 +342,94 @@ class Idea(db.Model):
 
         return cls.query.get(idea_id)
 
+# user's ideas sorted by latest
+db.Index("ix_ideas_user_id_modified", Idea.user_id, Idea.modified.desc())
+# all ideas sorted by latest and by votes, idea_id is the tie-breaker used by pagination
+db.Index("ix_ideas_modified_idea_id", Idea.modified.desc(), Idea.idea_id.desc())
+db.Index("ix_ideas_vote_count_modified_idea_id", Idea.vote_count.desc(), Idea.modified.desc(), Idea.idea_id.desc())
+# full-text search
+db.Index("ix_ideas_search_vector", Idea.search_vector, postgresql_using="gin")
+# version of pages showing votes
+db.Index("ix_ideas_votes_modified", Idea.votes_modified.desc())
+# version of search results
+db.Index("ix_ideas_search_indexed", Idea.search_indexed.desc())
+
+
+@event.listens_for(Idea, "after_insert")
+def queue_new_idea(mapper, connection, idea):
+    """Queue a new idea to make its text searchable."""
+
+    SearchIndexQueue.add(connection, idea.idea_id)
+
+@event.listens_for(Idea, "after_update")
+def queue_updated_idea(mapper, connection, idea):
+    """Queue an idea to update its searchable text if its title or description was changed."""
+
+    attrs = inspect(idea).attrs
+    if attrs.title.history.has_changes() or attrs.description.history.has_changes():
+        SearchIndexQueue.add(connection, idea.idea_id)
+
+
+def invalidate_after_commit(generation, cache):
+    """Bump the generation of cached data when the session is committed.
+    Bumping before commit would let another request cache the old data again."""
+
+    db.session.info.setdefault("cache_generations", set()).add((cache, generation))
+
+@event.listens_for(db.session, "after_commit")
+def bump_cache_generations(session):
+    for cache, generation in session.info.pop("cache_generations", ()):
+        cache.bump(generation)
+
+@event.listens_for(db.session, "after_soft_rollback")
+def forget_cache_generations(session, previous_transaction):
+    session.info.pop("cache_generations", None)
+
+class SearchIndexQueue(db.Model):
+    """An idea whose search_vector is out of date, 
+    search_vector is computed by search_indexer.py so the server doesn't do it on the request path."""
+
+    __tablename__ = "search_index_queue"
+
+    # one row per idea, changes made before the idea was indexed are indexed together
+    idea_id = db.Column(db.Integer, db.ForeignKey("ideas.idea_id", ondelete="CASCADE"), primary_key=True)
+    queued = db.Column(db.DateTime, nullable=False)
+
+
+    def __repr__(self):
+        return f"<SearchIndexQueue idea_id={self.idea_id} queued={self.queued}>"
+
+    @classmethod
+    def add(cls, connection, idea_id):
+        """Queue an idea in the transaction that changed it, does nothing if the idea is already queued."""
+
+        connection.execute(insert(cls.__table__).values(
+            idea_id=idea_id, queued=datetime.now()).on_conflict_do_nothing())
+
+    @classmethod
+    def index_pending(cls, batch_size=100):
+        """Update search_vector of a batch of queued ideas and return how many ideas were taken from the queue.
+
+        The queued rows stay locked until commit, so several indexers never take the same ideas, 
+        and an idea changed meanwhile is indexed from its latest version by the UPDATE."""
+
+        idea_ids = [idea_id for idea_id, in db.session.query(cls.idea_id).order_by(
+            cls.queued).limit(batch_size).with_for_update(skip_locked=True)]
+
+        if idea_ids:
+            cls.index_ideas(idea_ids)
+            cls.query.filter(cls.idea_id.in_(idea_ids)).delete(synchronize_session=False)
+
+        return len(idea_ids)
+
+    @staticmethod
+    def index_ideas(idea_ids):
+        """Compute search_vector of the ideas from their title and description."""
+
+        Idea.query.filter(Idea.idea_id.in_(idea_ids)).update(
+            {Idea.search_vector: fulltext.document(Idea.title, Idea.description), Idea.search_indexed: datetime.now()},
+            synchronize_session=False)
+
 class Vote(db.Model):
     """A vote for an idea left by a user."""
 
@@ -258,6 +456,45 @@ class Vote(db.Model):
             idea=idea, 
             modified=datetime.now())
 
+    @classmethod
+    def add(cls, user_id, idea_id):
+        """Vote for an idea and count the vote in one statement. 
+
+        Return id of the new vote, None if the user has already voted for the idea, and the number of votes of the idea."""
+
+        added = insert(cls.__table__).values(
+            user_id=user_id, idea_id=idea_id, modified=datetime.now()).on_conflict_do_nothing()
+
+        return cls.count_change(added, idea_id, 1)
+
+    @classmethod
+    def remove(cls, user_id, idea_id):
+        """Take back a vote for an idea and stop counting it in one statement. 
+
+        Return id of the deleted vote, None if the user hasn't voted for the idea, and the number of votes of the idea."""
+
+        deleted = delete(cls.__table__).where(cls.user_id == user_id, cls.idea_id == idea_id)
+
+        return cls.count_change(deleted, idea_id, -1)
+
+    @classmethod
+    def count_change(cls, change, idea_id, delta):
+        """Run the INSERT or DELETE of a vote and add delta to vote_count of the idea if a vote was changed.
+
+        The vote and the counter change together, so repeated or concurrent requests of a user can't count a vote twice."""
+
+        changed = change.returning(cls.vote_id, cls.idea_id).cte("changed_vote")
+        counted = update(Idea.__table__).where(Idea.idea_id == changed.c.idea_id).values(
+            vote_count=Idea.vote_count + delta, 
+            votes_modified=datetime.now()).returning(changed.c.vote_id, Idea.vote_count)
+
+        row = db.session.execute(counted).first()
+        if row is None:
+            # nothing changed, the vote was already there or already gone
+            return None, db.session.query(Idea.vote_count).filter(Idea.idea_id == idea_id).scalar()
+
+        return row.vote_id, row.vote_count
+
     @classmethod
     def get_by_idea_id(cls, idea_id):
         return cls.query.filter(cls.idea_id == idea_id).all()
@@ -270,6 +507,88 @@ class Vote(db.Model):
     def get_by_user_id_and_idea_id(cls, user_id, idea_id):
         return cls.query.filter(cls.user_id == user_id, cls.idea_id == idea_id).first()
 
+    @classmethod
+    def get_voted_idea_ids(cls, user_id, idea_ids):
+        """Return ids of ideas from idea_ids the user voted for."""
+
+        voted_ideas = db.session.query(cls.idea_id).filter(cls.user_id == user_id, cls.idea_id.in_(idea_ids))
+
+        return {idea_id for idea_id, in voted_ideas}
+
+# votes of an idea, votes of a user are covered by the unique (user_id, idea_id) constraint
+db.Index("ix_votes_idea_id", Vote.idea_id)
+
+
+class VoteBuffer(db.Model):
+    """A vote or unvote waiting to be written to votes and the vote counter by vote_writer.py.
+
+    Votes are buffered when VOTE_BUFFER is on, so votes for a popular idea don't wait for each other on the lock of its row."""
+
+    __tablename__ = "vote_buffer"
+
+    # one row per user and idea, only the last change is kept, so clicking many times writes at most one change
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    idea_id = db.Column(db.Integer, db.ForeignKey("ideas.idea_id", ondelete="CASCADE"), primary_key=True)
+    voted = db.Column(db.Boolean, nullable=False)
+    queued = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<VoteBuffer user_id={self.user_id} idea_id={self.idea_id} voted={self.voted}>"
+
+    @classmethod
+    def add(cls, user_id, idea_id, voted):
+        """Buffer a vote (voted=True) or unvote of the user, replacing the user's change of the idea that hasn't been written yet.
+
+        Return the number of votes of the idea the user will see once the change is written."""
+
+        if not vote_buffer_durable:
+            db.session.execute(text("SET LOCAL synchronous_commit TO OFF"))
+
+        added = insert(cls.__table__).values(user_id=user_id, idea_id=idea_id, voted=voted, queued=datetime.now())
+        db.session.execute(added.on_conflict_do_update(
+            index_elements=[cls.user_id, cls.idea_id], 
+            set_={"voted": added.excluded.voted, "queued": added.excluded.queued}))
+
+        has_voted = Vote.query.filter(Vote.user_id == user_id, Vote.idea_id == idea_id).exists()
+        vote_count, has_voted = db.session.query(Idea.vote_count, has_voted).filter(Idea.idea_id == idea_id).one()
+
+        return vote_count + voted - has_voted
+
+    @classmethod
+    def write_pending(cls, batch_size=1000):
+        """Write a batch of buffered changes to votes and the vote counters, return how many changes were taken.
+
+        The batch is written in the transaction that deletes it from the buffer, so after a crash 
+        the changes that weren't committed are still buffered and written by the next run. 
+        Changes repeating what is already in votes are skipped by the INSERT and the DELETE, so they are not counted."""
+
+        changes = db.session.query(cls.user_id, cls.idea_id, cls.voted).order_by(
+            cls.queued).limit(batch_size).with_for_update(skip_locked=True).all()
+        if not changes:
+            return 0
+
+        now = datetime.now()
+        votes = [{"user_id": user_id, "idea_id": idea_id, "modified": now} for user_id, idea_id, voted in changes if voted]
+        unvotes = [(user_id, idea_id) for user_id, idea_id, voted in changes if not voted]
+
+        deltas = Counter()
+        if votes:
+            added = insert(Vote.__table__).values(votes).on_conflict_do_nothing().returning(Vote.idea_id)
+            deltas.update(idea_id for idea_id, in db.session.execute(added))
+        if unvotes:
+            deleted = delete(Vote.__table__).where(tuple_(Vote.user_id, Vote.idea_id).in_(unvotes)).returning(Vote.idea_id)
+            deltas.subtract(idea_id for idea_id, in db.session.execute(deleted))
+
+        # one UPDATE per idea sent in batches, ideas are locked in order, so two writers can't deadlock
+        counts = [{"counted_idea_id": idea_id, "delta": delta} for idea_id, delta in sorted(deltas.items()) if delta]
+        if counts:
+            db.session.execute(update(Idea.__table__).where(Idea.idea_id == bindparam("counted_idea_id")).values(
+                vote_count=Idea.vote_count + bindparam("delta"), votes_modified=now), counts)
+
+        db.session.query(cls).filter(tuple_(cls.user_id, cls.idea_id).in_(
+            [(user_id, idea_id) for user_id, idea_id, voted in changes])).delete(synchronize_session=False)
+
+        return len(changes)
 
 
 class Comment(db.Model):
@@ -324,67 +643,223 @@ class Comment(db.Model):
 
     @classmethod
     def get_by_idea_id(cls, idea_id):
-        return cls.query.filter(cls.idea_id == idea_id).order_by(cls.modified.desc()).all()
+        """Return comments to an idea, latest first, with their authors loaded in the same query."""
+
+        return cls.query.options(db.joinedload(cls.user)).filter(
+            cls.idea_id == idea_id).order_by(cls.modified.desc()).all()
+
+    @classmethod
+    def get_page_by_idea_id(cls, idea_id, after, limit):
+        """Return up to limit comments to an idea with their authors, latest first, 
+        that come after the (modified, comment_id) pair, or from the first one if after is None."""
+
+        comments = cls.query.options(db.joinedload(cls.user)).filter(cls.idea_id == idea_id)
+        if after is not None:
+            comments = comments.filter(tuple_(cls.modified, cls.comment_id) < tuple_(*after))
+
+        return comments.order_by(cls.modified.desc(), cls.comment_id.desc()).limit(limit).all()
 
     @classmethod
     def get_by_user_id(cls, user_id):
         return cls.query.filter(cls.user_id == user_id).order_by(cls.modified.desc()).all()
 
     def email_notification(self):
-        """ send an email notification to the user whose idea has been commented on """
-        
-        receiver_email = self.idea.user.email
+        """ schedule an email notification to the user whose idea has been commented on,
+        it's sent only if the comment is committed """
         
-        text = f"""\
-        Hi {self.idea.user.username},
+        CommentNotification.schedule(self)
 
-        There is a new/updated comment to your idea {self.idea.title} http://localhost:5000/ideas/{self.idea_id}/comments:
-        {self.description}"""
+# comments of an idea and comments of a user sorted by latest
+db.Index("ix_comments_idea_id_modified", Comment.idea_id, Comment.modified.desc())
+db.Index("ix_comments_user_id_modified", Comment.user_id, Comment.modified.desc())
 
-        html = render_template(
-            'user_idea_notification.html', 
-            username=self.idea.user.username, 
-            idea_url=f"http://localhost:5000/ideas/{self.idea_id}/comments", 
-            idea_title=self.idea.title,
-            comment_description=self.description)
 
-        
-        send_email(text, html, "LightBulb notification", receiver_email)
+class OutboxEmail(db.Model):
+    """An email waiting in the outbox to be sent by mail_worker.py."""
+
+    __tablename__ = "email_outbox"
+
+    email_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    receiver_email = db.Column(db.String(50), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    text = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime)
+    # when the email should be tried next, None after the last failed attempt
+    next_attempt = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    sent = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<OutboxEmail email_id={self.email_id} receiver_email={self.receiver_email} subject={self.subject}>"
+
+    @classmethod
+    def create(cls, text, html, subject, receiver_email):
+        """Create an email and add it to the session, 
+        so it's sent only if the rest of the transaction is committed."""
+
+        created = datetime.now()
+
+        email = cls(
+            receiver_email=receiver_email,
+            subject=subject,
+            text=text,
+            html=html,
+            created=created,
+            next_attempt=created
+            )
+        db.session.add(email)
+
+        return email
+
+    @classmethod
+    def get_pending(cls, batch_size):
+        """Return emails that are due to be sent, locked until commit, 
+        so other workers skip them instead of sending them twice."""
 
+        return cls.query.filter(
+            cls.sent.is_(None), 
+            cls.next_attempt <= datetime.now()
+            ).order_by(cls.next_attempt).limit(batch_size).with_for_update(skip_locked=True).all()
 
-def connect_to_db(flask_app, db_uri="postgresql:///ideas", echo=True):
+# emails that are still waiting to be sent
+db.Index("ix_email_outbox_next_attempt", OutboxEmail.next_attempt, postgresql_where=OutboxEmail.sent.is_(None))
+
+
+class CommentNotification(db.Model):
+    """A comment the idea owner hasn't been notified about yet.
+    Notifications about the same idea are collected during the owner's notification_window 
+    and sent in one email by mail_worker.py."""
+
+    __tablename__ = "comment_notifications"
+
+    notification_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=False)
+    idea_id = db.Column(db.Integer, db.ForeignKey("ideas.idea_id"), nullable=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey("comments.comment_id", ondelete="CASCADE"), nullable=False)
+    created = db.Column(db.DateTime)
+    send_after = db.Column(db.DateTime)
+
+    user = db.relationship("User")
+    idea = db.relationship("Idea")
+    comment = db.relationship("Comment")
+
+    def __repr__(self):
+        return f"<CommentNotification notification_id={self.notification_id} comment_id={self.comment_id}>"
+
+    @classmethod
+    def schedule(cls, comment):
+        """Add a notification about a new or updated comment to the session."""
+
+        owner = comment.idea.user
+
+        # a notification about the previous version of an updated comment is replaced by the new one
+        if comment.comment_id is not None:
+            cls.query.filter(cls.comment_id == comment.comment_id).delete()
+
+        created = datetime.now()
+
+        db.session.add(cls(
+            user=owner,
+            idea=comment.idea,
+            comment=comment,
+            created=created,
+            send_after=created + timedelta(minutes=owner.notification_window)
+            ))
+
+    @classmethod
+    def get_due(cls):
+        """Return all notifications about ideas that have at least one notification due, 
+        locked until commit, so other workers skip them."""
+
+        due = db.session.query(cls.user_id, cls.idea_id).group_by(
+            cls.user_id, 
+            cls.idea_id
+            ).having(func.min(cls.send_after) <= datetime.now())
+
+        return cls.query.filter(
+            tuple_(cls.user_id, cls.idea_id).in_(due)
+            ).order_by(cls.user_id, cls.idea_id, cls.created).with_for_update(skip_locked=True).all()
+
+    @classmethod
+    def queue_digests(cls):
+        """Queue one email per user and idea about all due notifications 
+        and return the number of queued emails."""
+
+        digests = 0
+
+        for (user_id, idea_id), notifications in groupby(cls.get_due(), lambda n: (n.user_id, n.idea_id)):
+            notifications = list(notifications)
+            user = notifications[0].user
+            idea = notifications[0].idea
+            comments = [notification.comment for notification in notifications]
+            idea_url = f"http://localhost:5000/ideas/{idea.idea_id}/comments"
+
+            descriptions = "\n\n        ".join(comment.description for comment in comments)
+            text = f"""\
+        Hi {user.username},
+
+        There are new/updated comments to your idea {idea.title} {idea_url}:
+        {descriptions}"""
+
+            html = render_template(
+                'user_idea_notification.html', 
+                username=user.username, 
+                idea_url=idea_url, 
+                idea_title=idea.title,
+                comments=comments)
+
+            OutboxEmail.create(text, html, "LightBulb notification", user.email)
+
+            for notification in notifications:
+                db.session.delete(notification)
+
+            digests += 1
+
+        return digests
+
+# notifications are looked up by comment when it's updated and grouped by user and idea when sent
+db.Index("ix_comment_notifications_comment_id", CommentNotification.comment_id)
+db.Index("ix_comment_notifications_user_id_idea_id", CommentNotification.user_id, CommentNotification.idea_id)
+
+
+def get_engine_options(**options):
+    """Return options of the database engine from env variables, options override them."""
+
+    engine_options = {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pool_pre_ping,
+        "executemany_mode": executemany_mode,
+        "connect_args": {"options": f"-c statement_timeout={statement_timeout}"},
+    }
+    engine_options.update(options)
+
+    return engine_options
+
+
+def connect_to_db(flask_app, db_uri="postgresql:///ideas", echo=False, engine_options=None):
     flask_app.config["SQLALCHEMY_DATABASE_URI"] = db_uri
+    # echo logs every statement, it's for development only
     flask_app.config["SQLALCHEMY_ECHO"] = echo
+    flask_app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options or get_engine_options()
 
-    # flask-msearch will use table name as elasticsearch index name
-    flask_app.config["MSEARCH_INDEX_NAME"] = 'msearch'
-    # simple,whoosh,elaticsearch, default is simple
-    flask_app.config["MSEARCH_BACKEND"] = 'whoosh'
-    # table's primary key
-    flask_app.config["MSEARCH_PRIMARY_KEY"] = 'idea_id'
-    flask_app.config["MSEARCH_ENABLE"] = True
-    # SQLALCHEMY_TRACK_MODIFICATIONS must be set to True when msearch auto index is enabled
-    flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
-
+    flask_app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
     db.app = flask_app
     db.init_app(flask_app)
 
-    
-    search = Search(db=db)
-    search.init_app(flask_app)
-
-    print("Connected to the db!")
-
 
 if __name__ == "__main__":
-    from server import app
+    from server import create_app
 
-    # Call connect_to_db(app, echo=False) if your program output gets
-    # too annoying; this will tell SQLAlchemy not to print out every
-    # query it executes.
+    # create_app connects to the database, leave out SQLALCHEMY_ECHO if your program output gets
+    # too annoying; it tells SQLAlchemy to print out every query it executes.
 
-    connect_to_db(app)
+    app = create_app({"SQLALCHEMY_ECHO": True})
 
     # app.config['TESTING'] = True
     # # Connect to test database
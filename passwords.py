@@ -0,0 +1,99 @@
+"""Password hashing in a pool of worker processes, so slow bcrypt doesn't block the server."""
+
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import time
+import bcrypt
+import os
+
+
+# bcrypt work factor, every next round doubles the time to hash a password
+log_rounds = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# number of processes hashing passwords at the same time, more requests wait in the queue
+workers = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1))
+
+_pool = None
+_lock = threading.Lock()
+_metrics = {
+    "in_progress": 0,
+    "hash_count": 0,
+    "hash_seconds": 0.0,
+    "check_count": 0,
+    "check_seconds": 0.0,
+    "max_seconds": 0.0,
+}
+
+
+def _hash(password, log_rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(log_rounds))
+
+
+def _check(password, password_hash):
+    return bcrypt.checkpw(password, password_hash)
+
+
+def _get_pool():
+    # the pool is started on first use, so every server process starts its own
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+
+    return _pool
+
+
+def _run(name, func, *args):
+    """Run func in the pool, wait for the result and count how long it took."""
+
+    with _lock:
+        _metrics["in_progress"] += 1
+    start = time.perf_counter()
+
+    try:
+        return _get_pool().submit(func, *args).result()
+    finally:
+        # time includes waiting in the queue, that is what users of the server wait for
+        seconds = time.perf_counter() - start
+        with _lock:
+            _metrics["in_progress"] -= 1
+            _metrics[f"{name}_count"] += 1
+            _metrics[f"{name}_seconds"] += seconds
+            _metrics["max_seconds"] = max(_metrics["max_seconds"], seconds)
+
+
+def hash_password(password):
+    """Return bcrypt hash of the password using the configured work factor."""
+
+    return _run("hash", _hash, password, log_rounds)
+
+
+def check_password(password, password_hash):
+    """Return True if the password matches the hash."""
+
+    return _run("check", _check, password, password_hash)
+
+
+def needs_rehash(password_hash):
+    """Return True if the hash was made with a different work factor than the configured one."""
+
+    # bcrypt hash looks like $2a$12$<salt and hash>, where 12 is the work factor
+    try:
+        return int(password_hash.split("$")[2]) != log_rounds
+    except (AttributeError, IndexError, ValueError):
+        return False
+
+
+def get_metrics():
+    """Return number and average time of hashed and checked passwords, and current queue depth."""
+
+    with _lock:
+        metrics = dict(_metrics)
+
+    metrics["queue_depth"] = max(0, metrics["in_progress"] - workers)
+    metrics["workers"] = workers
+    metrics["log_rounds"] = log_rounds
+    metrics["avg_hash_seconds"] = metrics["hash_seconds"] / metrics["hash_count"] if metrics["hash_count"] else 0.0
+    metrics["avg_check_seconds"] = metrics["check_seconds"] / metrics["check_count"] if metrics["check_count"] else 0.0
+
+    return metrics
@@ -0,0 +1,7 @@
+"""Script to rebuild the number of votes of every idea from the votes table."""
+
+import crud
+import server
+
+server.create_app({"SQLALCHEMY_ECHO": True})
+crud.reconcile_vote_counts()
@@ -0,0 +1,60 @@
+"""Number and time of requests handled by the server process."""
+
+import os
+import threading
+import time
+
+
+_lock = threading.Lock()
+_metrics = {
+    "in_progress": 0,
+    "count": 0,
+    "seconds": 0.0,
+    "max_seconds": 0.0,
+    "statuses": {},
+    "endpoints": {},
+}
+
+
+def start():
+    """Count a request that started and return its start time."""
+
+    with _lock:
+        _metrics["in_progress"] += 1
+
+    return time.perf_counter()
+
+
+def finish(started, endpoint, status_code):
+    """Count a request that finished, time includes sending a streamed response."""
+
+    seconds = time.perf_counter() - started
+    status = f"{status_code // 100}xx"
+
+    with _lock:
+        _metrics["in_progress"] -= 1
+        _metrics["count"] += 1
+        _metrics["seconds"] += seconds
+        _metrics["max_seconds"] = max(_metrics["max_seconds"], seconds)
+        _metrics["statuses"][status] = _metrics["statuses"].get(status, 0) + 1
+
+        count, total = _metrics["endpoints"].get(endpoint, (0, 0.0))
+        _metrics["endpoints"][endpoint] = (count + 1, total + seconds)
+
+
+def get_metrics():
+    """Return number of requests by status, their average and maximum time, overall and by endpoint. 
+    Every server process counts its own requests, pid tells which process answered."""
+
+    with _lock:
+        metrics = dict(_metrics)
+        metrics["statuses"] = dict(_metrics["statuses"])
+        endpoints = dict(_metrics["endpoints"])
+
+    metrics["pid"] = os.getpid()
+    metrics["avg_seconds"] = metrics["seconds"] / metrics["count"] if metrics["count"] else 0.0
+    metrics["endpoints"] = {
+        endpoint: {"count": count, "avg_seconds": total / count}
+        for endpoint, (count, total) in endpoints.items()}
+
+    return metrics
@@ -0,0 +1,65 @@
+"""Worker that makes the text of new and changed ideas searchable.
+
+    python3 search_indexer.py          index queued ideas until stopped
+    python3 search_indexer.py reindex  rebuild search_vector of all ideas, e.g. after changing fulltext.document
+"""
+
+import sys
+import time
+from sqlalchemy import exc
+
+import model
+import server
+
+
+BATCH_SIZE = 100
+# seconds to wait for changed ideas when the queue is empty
+POLL_INTERVAL = 2
+# ideas rebuilt in one transaction by reindex
+REINDEX_CHUNK_SIZE = 1000
+
+
+def run():
+    """Index queued ideas until the worker is stopped. 
+    Every batch is committed at once, so searches see either old or new text of the ideas of a batch."""
+
+    while True:
+        try:
+            taken = model.SearchIndexQueue.index_pending(BATCH_SIZE)
+            model.db.session.commit()
+        except exc.SQLAlchemyError as err:
+            model.db.session.rollback()
+            print("Cannot index ideas:", err)
+            taken = 0
+
+        # if the batch was full there are probably more ideas waiting
+        if taken < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+def reindex(chunk_size=REINDEX_CHUNK_SIZE):
+    """Rebuild search_vector of all ideas in chunks ordered by idea_id. 
+    Every chunk is a short transaction, so the site keeps working and searching old text until the chunk is done."""
+
+    last_idea_id = 0
+    while True:
+        idea_ids = [idea_id for idea_id, in model.db.session.query(model.Idea.idea_id).filter(
+            model.Idea.idea_id > last_idea_id).order_by(model.Idea.idea_id).limit(chunk_size)]
+        if not idea_ids:
+            break
+
+        model.SearchIndexQueue.index_ideas(idea_ids)
+        model.db.session.commit()
+
+        last_idea_id = idea_ids[-1]
+        print(f"Indexed ideas up to {last_idea_id}")
+
+
+if __name__ == "__main__":
+    app = server.create_app()
+
+    with app.app_context():
+        if sys.argv[1:] == ["reindex"]:
+            reindex()
+        else:
+            run()
@@ -6,6 +6,7 @@ from random import choice, sample
 from datetime import datetime, timedelta
 # import sys
 
+import crud
 import model
 import server
 
@@ -14,9 +15,8 @@ import server
 os.system("dropdb ideas")
 os.system("createdb ideas")
 
-model.connect_to_db(server.app)
+server.create_app({"SQLALCHEMY_ECHO": True})
 model.db.create_all()
-# model.search.create_index()
 
 # Create 5 users
 users_in_db = []
@@ -83,4 +83,11 @@ for user in users_in_db:
         model.db.session.add(comment)
 
 
-model.db.session.commit()
\ No newline at end of file
+model.db.session.commit()
+
+# votes were added directly to the votes table, so count them for every idea
+crud.reconcile_vote_counts()
+
+# make ideas searchable
+model.SearchIndexQueue.index_pending(batch_size=None)
+model.db.session.commit()
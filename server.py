@@ -1,40 +1,239 @@
 """Server for movie ratings app."""
 
-from flask import Flask, render_template, request, flash, session, redirect, jsonify, abort, url_for
-from flask_dance.contrib.google import make_google_blueprint, google
-from model import connect_to_db, db, User, Idea, Vote, Comment
+from flask import Flask, Blueprint, current_app, render_template, request, flash, session, redirect, jsonify, abort, url_for, Response, stream_with_context, make_response, g
+from model import connect_to_db, get_engine_options, db, User, Idea, Vote, VoteBuffer, Comment
 from sqlalchemy import exc
 from itsdangerous import URLSafeTimedSerializer
 
 from jinja2 import StrictUndefined
+from functools import wraps
+from markupsafe import Markup
 import crud
 import os
+import glob
+import gzip
+import hashlib
+import hmac
+import time
+import passwords
+import request_metrics
+from cache import search_cache, fragment_cache, user_cache
+from sessions import ServerSessionInterface, get_store, revoke_user_sessions
 from utils import send_confirmation_email
 
-app = Flask(__name__)
-app.secret_key = os.environ['APP_SECRET_KEY']
-app.jinja_env.undefined = StrictUndefined
+# pages and API of the app, registered on the app by create_app
+routes = Blueprint("routes", __name__)
 
-client_id = os.environ['GOOGLE_CLIENT_ID']
-client_secret = os.environ['GOOGLE_CLIENT_SECRET']
 
-salt = os.environ['EMAIL_CONFIRMATION_SALT']
+def get_code_version():
+    """Return a hash of the code and templates of the app, the same in every server process until new code is deployed."""
 
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = sorted(glob.glob(os.path.join(root, "*.py")) + glob.glob(os.path.join(root, "templates", "*.html")))
 
-# A Blueprint object works similarly to a Flask application object, but it is not actually an application. 
-# Rather it is a blueprint of how to construct or extend an application.
-blueprint = make_google_blueprint(
-    client_id=client_id,
-    client_secret=client_secret,
-    scope=["profile", "email"],
-    redirect_url="/login_google"
-)
-app.register_blueprint(blueprint, url_prefix="/login")
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
 
-@app.route("/login_google")
+    return digest.hexdigest()
+
+
+# comments shown on the idea page at once, more are loaded while the user scrolls
+COMMENTS_PER_PAGE = 20
+# the most ideas per page the listing offers
+MAX_PER_PAGE = 50
+# part of every ETag, so pages cached before new code was deployed are not used, 
+# APP_VERSION (e.g. the commit deployed) saves hashing the code when every process starts
+CODE_VERSION = os.environ.get('APP_VERSION') or get_code_version()
+# smaller responses are not worth compressing
+GZIP_MIN_SIZE = 500
+# seconds a reverse proxy may show a page to anonymous users without asking the server
+PAGE_CACHE_SECONDS = int(os.environ.get('PAGE_CACHE_SECONDS', 10))
+# seconds a user reads from the primary after changing something, so the change is seen before replicas get it
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+# votes are written by vote_writer.py in batches instead of by every request
+BUFFER_VOTES = os.environ.get('VOTE_BUFFER', '0') == '1'
+
+
+def stream_template(template_name, **context):
+    """Render the template in parts that are sent to the browser as soon as they are ready 
+    (Flask 2.1 has no stream_template). The request context stays available while the page is streamed."""
+
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+
+    return Response(stream_with_context(template.generate(context)))
+
+
+@routes.app_template_global()
+def cached_fragment(*key, caller):
+    """Return the part of a template inside {% call cached_fragment(...) %}, rendered once for the key.
+
+    The key is made of everything the part shows that can change, e.g. id and modified time of an idea 
+    and its number of votes, so a change of any of them renders the part again, and old versions
+    are dropped from the cache as least recently used."""
+
+    key = ":".join(str(part) for part in key)
+
+    html = fragment_cache.get(key)
+    if html is None:
+        html = str(caller())
+        fragment_cache.set(key, html)
+
+    return Markup(html)
+
+
+@routes.before_app_request
+def start_request_metrics():
+    g.request_started = request_metrics.start()
+
+@routes.after_app_request
+def record_response_status(response):
+    g.response_status = response.status_code
+
+    return response
+
+@routes.teardown_app_request
+def finish_request_metrics(error):
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+
+    # the request context of a streamed page is torn down when the page is sent, not when the response starts
+    request_metrics.finish(started, request.endpoint or "unknown", g.get("response_status", 500))
+
+
+@routes.after_app_request
+def pin_to_primary(response):
+    if db.session.info.get("wrote") and current_app.config.get("SQLALCHEMY_BINDS"):
+        session["primary_until"] = time.time() + REPLICA_PIN_SECONDS
+
+    return response
+
+
+def read_only(view):
+    """Let the view read from a replica, unless the user has just changed something the replica may not have yet."""
+
+    @wraps(view)
+    def read_only_view(*args, **kwargs):
+        g.read_only = session.get("primary_until", 0) < time.time()
+        return view(*args, **kwargs)
+
+    return read_only_view
+
+
+def get_current_user():
+    """Return the signed in user or None. 
+    The user is loaded at most once per request and kept in the user cache between requests until the user is changed."""
+
+    if "current_user" not in g:
+        user_id = session.get("user_id")
+        g.current_user = User.get_cached(user_id) if user_id else None
+
+    return g.current_user
+
+
+def get_listing_args():
+    """Return page, number of ideas per page, search, sort and cursor of the ideas listing from the query string."""
+
+    page = int(request.args.get("page", "1"))
+    # a page is read and rendered at once, so it can't be larger than the largest page the listing offers
+    perpage = min(max(int(request.args.get("perpage", "10")), 1), MAX_PER_PAGE)
+
+    search = request.args.get("search", "")
+    sort = request.args.get("sort", "latest")
+    # ideas are paged with a cursor, unless page number is asked for explicitly
+    cursor = request.args.get("cursor", None if "page" in request.args else "")
+
+    return page, perpage, search, sort, cursor
+
+
+def get_page_etag(get_versions):
+    """Return ETag of a page that is the same for all anonymous users, made of version stamps 
+    of the data shown on the page returned by get_versions, or None if the page is personal."""
+
+    if session.get("user_id") or "_flashes" in session:
+        return None
+
+    versions = (CODE_VERSION, request.full_path) + tuple(get_versions())
+
+    return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+
+def not_modified(etag):
+    """Return 304 response if the browser already has the version of the page with the ETag, otherwise None."""
+
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return cacheable(Response(status=304), etag)
+
+    return None
+
+
+def cacheable(response, etag):
+    """Let browsers and proxies keep a page for anonymous users and check it with the ETag, 
+    keep personal pages private."""
+
+    response.vary.add("Cookie")
+
+    if etag is None:
+        response.cache_control.private = True
+    else:
+        response.set_etag(etag, weak=True)
+        response.cache_control.public = True
+        # browsers check the page every time, proxies in a while
+        response.cache_control.max_age = 0
+        response.cache_control.s_maxage = PAGE_CACHE_SECONDS
+
+    return response
+
+
+def ideas_page_json(ideas_with_votes):
+    """Return JSON response with the ideas on the page and links to other pages, 
+    for the listing to be updated without reloading the page.
+
+    The response has a weak ETag, so an unchanged page is answered with 304, 
+    and is compressed with gzip if the browser accepts it."""
+
+    data = {
+        "success": True,
+        "ideas": [{
+            "idea_id": idea.idea_id,
+            "title": idea.title,
+            "total_votes": total_votes,
+            "user_vote": user_vote,
+            "modified": idea.modified.strftime('%Y-%m-%d'),
+            } for idea, total_votes, user_vote in ideas_with_votes.items],
+        "pages": ideas_with_votes.pages,
+    }
+
+    if ideas_with_votes.pages is None:
+        data["next_cursor"] = ideas_with_votes.next_cursor
+        data["prev_cursor"] = ideas_with_votes.prev_cursor
+    else:
+        data["next_num"] = ideas_with_votes.next_num if ideas_with_votes.has_next else None
+        data["prev_num"] = ideas_with_votes.prev_num if ideas_with_votes.has_prev else None
+
+    response = jsonify(data)
+    # votes of the logged in user are part of the page
+    response.vary.add("Cookie")
+    response.vary.add("Accept-Encoding")
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+    response.make_conditional(request)
+
+    if response.status_code == 200 and request.accept_encodings["gzip"] and len(response.get_data()) >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers["Content-Encoding"] = "gzip"
+
+    return response
+
+
+@routes.route("/login_google")
 def process_google_auth():
     """Handling user authorization through Google."""
 
+    from flask_dance.contrib.google import google
+
     if google.authorized:
         user_info = google.get('/oauth2/v2/userinfo')
         if user_info.ok:
@@ -56,7 +255,7 @@ def process_google_auth():
         
         return redirect("/all-ideas")
 
-@app.route("/login", methods=['GET', 'POST'])
+@routes.route("/login", methods=['GET', 'POST'])
 def process_login():
     """Process user login."""
 
@@ -73,6 +272,15 @@ def process_login():
             abort(400, "The email or password you entered was incorrect.")
         elif not user.email_confirmed:
             abort(400, "You have not activated your account.")
+
+        if passwords.needs_rehash(user.password_hash):
+            # the password was hashed with a different work factor than the configured one
+            user.password = password
+            try:
+                db.session.commit()
+            except exc.SQLAlchemyError as err:
+                db.session.rollback()
+
         # Log in user by storing the user's id in session
         session["user_id"] = user.user_id
         return jsonify({"success": True})
@@ -81,7 +289,7 @@ def process_login():
         return render_template("login.html")
 
 
-@app.route("/logout")
+@routes.route("/logout")
 def process_logout():
     """Process user logout."""
 
@@ -89,7 +297,7 @@ def process_logout():
     return redirect("/")
 
 
-@app.route("/users", methods=['GET', 'POST'])
+@routes.route("/users", methods=['GET', 'POST'])
 def join():
     """Handle creating of a new user."""
 
@@ -125,9 +333,9 @@ def join():
             try:
                 if new_user:
                     db.session.add(user)
+                send_confirmation_email(user.email)
                 db.session.commit()
 
-                send_confirmation_email(user.email)
                 return jsonify({ 
                     "success": True,
                     "joined": user.user_id
@@ -140,11 +348,11 @@ def join():
     else:
         return render_template("join.html")
 
-@app.route("/confirm_email/<token>")
+@routes.route("/confirm_email/<token>")
 def confirm_email(token):
     try:
-        confirm_serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'])
-        email = confirm_serializer.loads(token, salt=salt, max_age=3600)
+        confirm_serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+        email = confirm_serializer.loads(token, salt=current_app.config['EMAIL_CONFIRMATION_SALT'], max_age=3600)
     except:
         flash('The confirmation link is invalid or has expired.')
         return redirect('/')
@@ -165,33 +373,43 @@ def confirm_email(token):
  
     return redirect('/')
 
-@app.route("/")
+@routes.route("/")
 def homepage():
     """View homepage."""
 
     return render_template("homepage.html")
 
-@app.route("/all-ideas")
+@routes.route("/all-ideas")
+@read_only
 def ideas_per_page():
     """View all ideas with pagination."""
 
-    page = int(request.args.get("page", "1"))
-    perpage = int(request.args.get("perpage", "10"))
+    page, perpage, search, sort, cursor = get_listing_args()
 
-    search = request.args.get("search", "")
-    sort = request.args.get("sort", "latest")
+    try:
+        crud.validate_cursor(cursor, sort)
+    except ValueError as err:
+        abort(400, err.args[0])
+
+    etag = get_page_etag(crud.get_ideas_version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
-    ideas_with_votes = crud.get_ideas_with_votes_filtered(session.get("user_id"), search, sort, page, perpage)
+    # the header and the search form are sent before the listing query runs
+    ideas_with_votes = crud.DeferredPage(
+        crud.get_ideas_with_votes_filtered, session.get("user_id"), search, sort, page, perpage, cursor)
 
-    return render_template("ideas.html", 
+    return cacheable(stream_template("ideas.html", 
     ideas=ideas_with_votes, 
     title="Ideas",
     search=search, 
     sort=sort, 
     perpage=perpage, 
-    action="/all-ideas")
+    action="/all-ideas",
+    api_url="/api/ideas"), etag)
 
-@app.route("/ideas", methods=['GET', 'POST'])
+@routes.route("/ideas", methods=['GET', 'POST'])
 def create_idea():
     """handle creating an idea."""
 
@@ -200,7 +418,7 @@ def create_idea():
         if not session.get("user_id"):
             abort(400, "User did not login to the application.")
 
-        user = User.get_by_id(session["user_id"])
+        user = get_current_user()
         title = request.json.get("title")
         description = request.json.get("description")
         link = request.json.get("link")
@@ -225,7 +443,7 @@ def create_idea():
 
         return render_template("idea_details.html", method="POST")
 
-@app.route("/ideas/<idea_id>", methods=['GET', 'PUT'])
+@routes.route("/ideas/<idea_id>", methods=['GET', 'PUT'])
 def edit_idea(idea_id):
     """Handle changing of an idea """
 
@@ -260,18 +478,47 @@ def edit_idea(idea_id):
 
         return render_template("idea_details.html", idea=idea, method="PUT")
 
-@app.route("/ideas/<idea_id>/comments")
+@routes.route("/ideas/<idea_id>/comments")
+@read_only
 def show_idea(idea_id):
     """Show details of an idea with all comments to this idea."""
 
-    idea = Idea.get_by_id(idea_id)
-    comments = Comment.get_by_idea_id(idea_id)
+    # the page shows authors of the idea and of every comment, they are loaded with the idea and the comments
+    idea_with_versions = crud.get_idea_with_comments_version(idea_id)
+    if idea_with_versions is None:
+        abort(404)
+    idea, comments_version = idea_with_versions
+
+    etag = get_page_etag(lambda: (idea.modified, idea.vote_count, idea.user.username) + comments_version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    # only the first page of comments is shown, next pages are loaded while the user scrolls
+    comments = crud.get_comments_page(idea_id, "", COMMENTS_PER_PAGE)
     idea_votes = crud.get_idea_votes(session.get("user_id"), idea_id)
 
-    return render_template("idea_details_with_comments.html", idea=idea, comments=comments, idea_votes=idea_votes)
+    return cacheable(make_response(render_template(
+        "idea_details_with_comments.html", idea=idea, comments=comments, idea_votes=idea_votes)), etag)
+
+@routes.route("/ideas/<idea_id>/comments/more")
+@read_only
+def show_more_comments(idea_id):
+    """Return html of the next page of comments to an idea and the cursor of the page after it."""
+
+    try:
+        comments = crud.get_comments_page(idea_id, request.args.get("cursor", ""), COMMENTS_PER_PAGE)
+    except ValueError as err:
+        abort(400, err.args[0])
+
+    return jsonify({
+        "success": True,
+        "html": render_template("comments.html", comments=comments.items),
+        "next_cursor": comments.next_cursor
+    })
 
 
-@app.route("/users/<user_id>")
+@routes.route("/users/<user_id>")
 def show_user(user_id):
     """Show user settings"""
     user = User.get_by_id(user_id)
@@ -279,7 +526,7 @@ def show_user(user_id):
     return render_template("user_settings.html", user=user)
 
 
-@app.route("/users/<user_id>/details", methods=['PUT'])
+@routes.route("/users/<user_id>/details", methods=['PUT'])
 def edit_user_details(user_id):
     """Update user details: username, description."""
 
@@ -288,8 +535,9 @@ def edit_user_details(user_id):
 
     username = request.json.get("username")
     description = request.json.get("description")
+    notification_window = request.json.get("notification_window")
     try:
-        user = User.update_details(user_id, username, description)
+        user = User.update_details(user_id, username, description, notification_window)
     except ValueError as err:
         abort(400, err.args[0])
 
@@ -304,7 +552,7 @@ def edit_user_details(user_id):
         db.session.rollback()
         abort(422)
 
-@app.route("/users/<user_id>/password", methods=['PUT'])
+@routes.route("/users/<user_id>/password", methods=['PUT'])
 def edit_user_password(user_id):
     """Update user password."""
 
@@ -321,6 +569,8 @@ def edit_user_password(user_id):
 
     try:
         db.session.commit()
+        # browsers signed in with the old password are signed out
+        revoke_user_sessions(user.user_id, keep=session.sid)
         return jsonify({ 
             "success": True,
             "updated": user_id
@@ -330,22 +580,49 @@ def edit_user_password(user_id):
         db.session.rollback()
         abort(422)
 
-@app.route("/users/<user_id>/ideas")
+@routes.route("/users/<user_id>/sessions", methods=['DELETE'])
+def revoke_sessions(user_id):
+    """Sign the user out in all browsers."""
+
+    if not session.get("user_id") or int(user_id) != session["user_id"]:
+        abort(400, "User did not login to the application.")
+
+    revoke_user_sessions(session["user_id"])
+    session.clear()
+
+    return jsonify({ 
+        "success": True,
+        "revoked": user_id
+        })
+
+@routes.route("/users/<user_id>/ideas")
+@read_only
 def user_ideas(user_id):
     """Show all ideas created by user."""
 
-    page = int(request.args.get("page", "1"))
-    perpage = int(request.args.get("perpage", "10"))
+    page, perpage, search, sort, cursor = get_listing_args()
 
-    search = request.args.get("search", "")
-    sort = request.args.get("sort", "latest")
+    try:
+        crud.validate_cursor(cursor, sort)
+    except ValueError as err:
+        abort(400, err.args[0])
 
-    ideas_with_votes = crud.get_user_ideas_with_votes_filtered(user_id, session.get("user_id"), search, sort, page, perpage)
     user = User.get_by_id(user_id)
+    if user is None:
+        abort(404)
+
+    etag = get_page_etag(lambda: (user.username, user.description) + crud.get_ideas_version(user_id))
+    response = not_modified(etag)
+    if response is not None:
+        return response
 
     most_voted_idea = crud.get_most_voted_user_idea(user_id)
 
-    return render_template("ideas.html", 
+    # the header and the search form are sent before the listing query runs
+    ideas_with_votes = crud.DeferredPage(
+        crud.get_user_ideas_with_votes_filtered, user_id, session.get("user_id"), search, sort, page, perpage, cursor)
+
+    return cacheable(stream_template("ideas.html", 
     ideas=ideas_with_votes, 
     title="My ideas",
     user=user, 
@@ -353,32 +630,83 @@ def user_ideas(user_id):
     search=search, 
     sort=sort,
     perpage=perpage,
-    action = f"/users/{user_id}/ideas")
+    action=f"/users/{user_id}/ideas",
+    api_url=f"/api/users/{user_id}/ideas"), etag)
 
 
-@app.route("/users/<user_id>/votes")
+@routes.route("/users/<user_id>/votes")
+@read_only
 def user_votes(user_id):
     """Show all ideas user voted for."""
 
-    page = int(request.args.get("page", "1"))
-    perpage = int(request.args.get("perpage", "10"))
+    page, perpage, search, sort, cursor = get_listing_args()
 
-    search = request.args.get("search", "")
-    sort = request.args.get("sort", "latest")
+    try:
+        crud.validate_cursor(cursor, sort)
+    except ValueError as err:
+        abort(400, err.args[0])
 
-    ideas_with_votes = crud.get_voted_by_user_ideas_with_votes_filtered(user_id, search, sort, page, perpage)
+    # the header and the search form are sent before the listing query runs
+    ideas_with_votes = crud.DeferredPage(
+        crud.get_voted_by_user_ideas_with_votes_filtered, user_id, search, sort, page, perpage, cursor)
 
-    return render_template("ideas.html", 
+    return stream_template("ideas.html", 
     ideas=ideas_with_votes, 
     title="My votes",
     perpage=perpage, 
     search=search, 
     sort=sort,
-    action=f"/users/{user_id}/votes")
+    action=f"/users/{user_id}/votes",
+    api_url=f"/api/users/{user_id}/votes")
+
+
 
+@routes.route("/api/ideas")
+@read_only
+def api_ideas_per_page():
+    """Return a page of all ideas as JSON."""
 
+    page, perpage, search, sort, cursor = get_listing_args()
+
+    try:
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(session.get("user_id"), search, sort, page, perpage, cursor)
+    except ValueError as err:
+        abort(400, err.args[0])
 
-@app.route("/comments/<idea_id>", methods=['GET', 'POST'])
+    return ideas_page_json(ideas_with_votes)
+
+
+@routes.route("/api/users/<user_id>/ideas")
+@read_only
+def api_user_ideas(user_id):
+    """Return a page of ideas created by user as JSON."""
+
+    page, perpage, search, sort, cursor = get_listing_args()
+
+    try:
+        ideas_with_votes = crud.get_user_ideas_with_votes_filtered(user_id, session.get("user_id"), search, sort, page, perpage, cursor)
+    except ValueError as err:
+        abort(400, err.args[0])
+
+    return ideas_page_json(ideas_with_votes)
+
+
+@routes.route("/api/users/<user_id>/votes")
+@read_only
+def api_user_votes(user_id):
+    """Return a page of ideas user voted for as JSON."""
+
+    page, perpage, search, sort, cursor = get_listing_args()
+
+    try:
+        ideas_with_votes = crud.get_voted_by_user_ideas_with_votes_filtered(user_id, search, sort, page, perpage, cursor)
+    except ValueError as err:
+        abort(400, err.args[0])
+
+    return ideas_page_json(ideas_with_votes)
+
+
+@routes.route("/comments/<idea_id>", methods=['GET', 'POST'])
 def create_comment(idea_id):
     """handle creating a comment."""
 
@@ -387,7 +715,7 @@ def create_comment(idea_id):
         if not session.get("user_id"):
             abort(400, "User did not login to the application.")
 
-        user = User.get_by_id(session["user_id"])
+        user = get_current_user()
         idea = Idea.get_by_id(idea_id)
         description = request.json.get("description")
         
@@ -411,7 +739,7 @@ def create_comment(idea_id):
 
         return render_template("comment_details.html", idea=idea, method="POST")
 
-@app.route("/comments/<idea_id>/<comment_id>", methods=['GET', 'PUT', 'DELETE'])
+@routes.route("/comments/<idea_id>/<comment_id>", methods=['GET', 'PUT', 'DELETE'])
 def edit_comment(idea_id, comment_id):
     """handle changing a comment."""
 
@@ -461,56 +789,97 @@ def edit_comment(idea_id, comment_id):
         return render_template("comment_details.html", idea=idea, comment=comment, method="PUT")
 
 
-@app.route("/votes", methods=['POST'])
+def get_voted_idea_id():
+    """Return the id of the idea a vote request is for, abort if it's missing. 
+    An idea that doesn't exist is found by the statement changing the vote, without a query of its own."""
+
+    try:
+        return int((request.get_json(silent=True) or {}).get("idea_id"))
+    except (TypeError, ValueError):
+        abort(400, "The idea to vote for is missing.")
+
+
+@routes.route("/votes", methods=['POST'])
 def create_vote():
-    """Create a vote."""
+    """Create a vote, a repeated vote changes nothing. Return the number of votes of the idea."""
 
-    idea_id = request.json.get("idea_id")
-    idea = Idea.get_by_id(idea_id)
     if not session.get("user_id"):
         abort(400, "User did not login to the application.")
 
-    user_id = session["user_id"]
-    user = User.get_by_id(user_id)
-    
-    vote = Vote.create(user, idea)
+    idea_id = get_voted_idea_id()
+
     try:
-        db.session.add(vote)
+        if BUFFER_VOTES:
+            vote_id, total_votes = None, VoteBuffer.add(session["user_id"], idea_id, True)
+        else:
+            vote_id, total_votes = Vote.add(session["user_id"], idea_id)
+        if total_votes is None:
+            # the vote and the idea weren't found
+            abort(404)
         db.session.commit()
         return jsonify({ 
             "success": True,
-             "added": vote.vote_id
+            "added": vote_id,
+            "total_votes": total_votes
         })
+    except exc.IntegrityError:
+        # the vote refers to an idea that doesn't exist
+        db.session.rollback()
+        abort(404)
     except exc.SQLAlchemyError as err:
         db.session.rollback()
         abort(422)
 
 
-@app.route("/votes", methods=['DELETE'])
+@routes.route("/votes", methods=['DELETE'])
 def delete_vote():
-    """delete a vote."""
+    """delete a vote, deleting a vote that doesn't exist changes nothing. Return the number of votes of the idea."""
 
-    idea_id = request.json.get("idea_id")
     if not session.get("user_id"):
         abort(400, "User did not login to the application.")
 
-    user_id = session["user_id"]
-    
-    vote = Vote.get_by_user_id_and_idea_id(user_id, idea_id)
-    vote_id = vote.vote_id
+    idea_id = get_voted_idea_id()
 
     try:
-        db.session.delete(vote)
+        if BUFFER_VOTES:
+            vote_id, total_votes = None, VoteBuffer.add(session["user_id"], idea_id, False)
+        else:
+            vote_id, total_votes = Vote.remove(session["user_id"], idea_id)
+        if total_votes is None:
+            # the vote and the idea weren't found
+            abort(404)
         db.session.commit()
         return jsonify({ 
             "success": True,
-             "deleted": vote_id
+            "deleted": vote_id,
+            "total_votes": total_votes
         })
+    except exc.IntegrityError:
+        # the vote refers to an idea that doesn't exist
+        db.session.rollback()
+        abort(404)
     except exc.SQLAlchemyError as err:
         db.session.rollback()
         abort(422)
 
-@app.errorhandler(400)
+@routes.route("/metrics")
+def show_metrics():
+    """Show server metrics to monitoring that knows the metrics token."""
+
+    token = current_app.config["METRICS_TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not token or not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        abort(404)
+
+    return jsonify({
+        "passwords": passwords.get_metrics(),
+        "search_cache": search_cache.get_metrics(),
+        "fragment_cache": fragment_cache.get_metrics(),
+        "user_cache": user_cache.get_metrics(),
+        "requests": request_metrics.get_metrics(),
+    })
+
+@routes.app_errorhandler(400)
 def custom400(error):
     return jsonify({
         "success": False,
@@ -518,7 +887,7 @@ def custom400(error):
         "message": error.description
     }), 400
 
-@app.errorhandler(404)
+@routes.app_errorhandler(404)
 def not_found(error):
     return jsonify({
         "success": False,
@@ -526,7 +895,7 @@ def not_found(error):
         "message": "resource not found"
     }), 404
 
-@app.errorhandler(422)
+@routes.app_errorhandler(422)
 def unprocessable(error):
     return jsonify({
         "success": False,
@@ -542,7 +911,7 @@ def unprocessable(error):
 #         "message": "bed request"
 #     }), 400
 
-@app.errorhandler(405)
+@routes.app_errorhandler(405)
 def not_allowed(error):
     return jsonify({
         "success": False,
@@ -550,7 +919,7 @@ def not_allowed(error):
         "message": "method not allowed"
     }), 405
 
-@app.errorhandler(500)
+@routes.app_errorhandler(500)
 def server_error(error):
     return jsonify({
         "success": False,
@@ -559,8 +928,51 @@ def server_error(error):
     }), 500
 
 
+def create_app(config=None):
+    """Create the app connected to the database. Settings are read from env variables, config overrides them.
+
+    Secrets are only used when they are needed: a missing secret breaks sessions, Google sign in 
+    or confirmation emails, but not creating the app, so scripts and tests don't need all of them. 
+    Production WSGI servers load the app with wsgi.py."""
+
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY=os.environ.get('APP_SECRET_KEY'),
+        GOOGLE_OAUTH_CLIENT_ID=os.environ.get('GOOGLE_CLIENT_ID'),
+        GOOGLE_OAUTH_CLIENT_SECRET=os.environ.get('GOOGLE_CLIENT_SECRET'),
+        EMAIL_CONFIRMATION_SALT=os.environ.get('EMAIL_CONFIRMATION_SALT'),
+        SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', "postgresql:///ideas"),
+        SQLALCHEMY_ECHO=False,
+        SQLALCHEMY_ENGINE_OPTIONS=get_engine_options(),
+        # read-only pages read from replicas, comma separated URLs
+        SQLALCHEMY_BINDS={f"replica_{n}": url for n, url in enumerate(
+            filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(",")))},
+        # where sessions are kept: database, redis (SESSION_REDIS_URL) or memory of the process
+        SESSION_STORE=os.environ.get('SESSION_STORE', 'database'),
+        # /metrics is shown only with the header "Authorization: Bearer <METRICS_TOKEN>", without a token it's not shown
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+        )
+    app.config.update(config or {})
+    app.jinja_env.undefined = StrictUndefined
+    app.session_interface = ServerSessionInterface(get_store(app.config["SESSION_STORE"]))
+
+    app.register_blueprint(routes)
+
+    # Google sign in, client id and secret are read from app.config when a user signs in
+    from flask_dance.contrib.google import make_google_blueprint
+    app.register_blueprint(
+        make_google_blueprint(scope=["profile", "email"], redirect_url="/login_google"), 
+        url_prefix="/login")
+
+    connect_to_db(app, app.config["SQLALCHEMY_DATABASE_URI"], app.config["SQLALCHEMY_ECHO"], 
+                  app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+
+    return app
+
+
 if __name__ == "__main__":
-    connect_to_db(app)
+    # development server, see wsgi.py and gunicorn.conf.py for production
+    app = create_app({"SQLALCHEMY_ECHO": True})
     # app.run('0.0.0.0', debug=True, port=8100, ssl_context=(
     #     'certificates/server.crt', 
     #     'certificates/server.key'))
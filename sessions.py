@@ -0,0 +1,217 @@
+"""Sessions kept on the server, the cookie holds only a random session id.
+
+A session of a user can be revoked at once, e.g. after the password was changed,
+instead of staying valid until its cookie expires."""
+
+from datetime import datetime
+from random import randint
+import hashlib
+import secrets
+import threading
+import time
+import os
+
+from flask import current_app
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SecureCookieSession
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+
+from model import db, UserSession
+
+
+# Redis used by the "redis" session store
+redis_url = os.environ.get('SESSION_REDIS_URL', 'redis://localhost:6379/0')
+
+# session data is serialized as Flask serializes cookie sessions, so flashed messages and other tagged values work
+serializer = TaggedJSONSerializer()
+
+
+class ServerSession(SecureCookieSession):
+    """Session data with the id of the session it was loaded from."""
+
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        # a different user in the session when it's saved gets a new session id
+        self.loaded_user_id = dict.get(self, "user_id")
+
+
+class MemorySessionStore:
+    """Sessions in the server process."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        with self._lock:
+            expires, data, user_id = self._sessions.get(key, (0, None, None))
+            if expires < time.time():
+                self._sessions.pop(key, None)
+                return None
+
+            return data
+
+    def save(self, key, data, user_id, lifetime):
+        with self._lock:
+            self._sessions[key] = (time.time() + lifetime.total_seconds(), data, user_id)
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def delete_user(self, user_id, keep=None):
+        with self._lock:
+            for key in [key for key, (expires, data, owner) in self._sessions.items() if owner == user_id and key != keep]:
+                del self._sessions[key]
+
+
+class RedisSessionStore:
+    """Sessions in Redis, expired sessions are dropped by Redis."""
+
+    def __init__(self, url, prefix="lightbulb:session:"):
+        # redis is only needed if sessions are kept there
+        import redis
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def load(self, key):
+        data = self._redis.get(self.prefix + key)
+
+        return None if data is None else data.decode()
+
+    def save(self, key, data, user_id, lifetime):
+        pipeline = self._redis.pipeline()
+        pipeline.set(self.prefix + key, data, ex=lifetime)
+        if user_id is not None:
+            # sessions of a user, to revoke them all
+            pipeline.sadd(f"{self.prefix}user:{user_id}", key)
+            pipeline.expire(f"{self.prefix}user:{user_id}", lifetime)
+        pipeline.execute()
+
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+
+    def delete_user(self, user_id, keep=None):
+        keys = [key.decode() for key in self._redis.smembers(f"{self.prefix}user:{user_id}")]
+        keys = [key for key in keys if key != keep]
+        if keys:
+            self._redis.delete(*[self.prefix + key for key in keys])
+            self._redis.srem(f"{self.prefix}user:{user_id}", *keys)
+
+
+class DatabaseSessionStore:
+    """Sessions in the user_sessions table.
+
+    Sessions are read and written on their own connection, so saving a session never commits the changes of a request."""
+
+    def __init__(self):
+        self.table = UserSession.__table__
+
+    def load(self, key):
+        with db.engine.connect() as connection:
+            return connection.execute(select(self.table.c.data).where(
+                self.table.c.session_id == key, self.table.c.expires > datetime.now())).scalar()
+
+    def save(self, key, data, user_id, lifetime):
+        now = datetime.now()
+        saved = insert(self.table).values(session_id=key, user_id=user_id, data=data, expires=now + lifetime)
+
+        with db.engine.begin() as connection:
+            connection.execute(saved.on_conflict_do_update(
+                index_elements=[self.table.c.session_id],
+                set_={"user_id": saved.excluded.user_id, "data": saved.excluded.data, "expires": saved.excluded.expires}))
+            # expired sessions are dropped now and then, so the table doesn't grow forever
+            if randint(1, 100) == 1:
+                connection.execute(delete(self.table).where(self.table.c.expires <= now))
+
+    def delete(self, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(self.table.c.session_id == key))
+
+    def delete_user(self, user_id, keep=None):
+        with db.engine.begin() as connection:
+            connection.execute(delete(self.table).where(
+                self.table.c.user_id == user_id, self.table.c.session_id != keep))
+
+
+def get_store(name):
+    """Return the session store by name: "database" shares sessions between server processes in the user_sessions table, 
+    "redis" in Redis, "memory" keeps them in the server process, so it works with a single process only."""
+
+    if name == "memory":
+        return MemorySessionStore()
+    if name == "redis":
+        return RedisSessionStore(redis_url)
+
+    return DatabaseSessionStore()
+
+
+def get_key(sid):
+    """Return the key a session is stored by: a hash of its id, so stored sessions can't be used to sign in."""
+
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface keeping session data in a store, the cookie holds a random session id.
+
+    A session is saved only when it was changed, and it expires PERMANENT_SESSION_LIFETIME after that."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(get_key(sid))
+            if data is not None:
+                return ServerSession(serializer.loads(data), sid)
+
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session.modified:
+            return
+
+        if not session:
+            # logged out and nothing else to keep
+            if session.sid:
+                self.store.delete(get_key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+            return
+
+        user_id = session.get("user_id")
+        if session.sid is None or user_id != session.loaded_user_id:
+            # a new id when a user signs in or out, so an id known before can't be used to act as the user
+            if session.sid:
+                self.store.delete(get_key(session.sid))
+            session.sid = secrets.token_urlsafe(32)
+            session.loaded_user_id = user_id
+
+        self.store.save(get_key(session.sid), serializer.dumps(dict(session)), user_id, app.permanent_session_lifetime)
+
+        response.set_cookie(
+            name, session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app))
+
+
+def revoke_user_sessions(user_id, keep=None):
+    """Sign the user out in all browsers, except the session with id keep."""
+
+    current_app.session_interface.store.delete_user(user_id, None if keep is None else get_key(keep))
@@ -25,38 +25,75 @@ addCommentButton.addEventListener('click', (evt) => {
 });
 
 
-const editCommentButtons = document.querySelectorAll('.edit-comment');
+// comments loaded while scrolling are added to the same container, so clicks are handled on the container
+const comments = document.querySelector('#comments');
 
-for (button of editCommentButtons){
-  button.addEventListener('click', (evt) => {
+comments.addEventListener('click', (evt) => {
+  const button = evt.target.closest('.edit-comment, .delete-comment');
+  if (!button) {
+    return;
+  }
+  evt.preventDefault();
+
+  const idea_id = location.pathname.split('/')[2];
+  const comment_id = button.id;
+  const url = `/comments/${idea_id}/${comment_id}`;
+
+  if (button.classList.contains('edit-comment')) {
     // open comment form 
-    const idea_id = location.pathname.split('/')[2];
-    const comment_id = evt.target.parentElement.id;
-    const url = `/comments/${idea_id}/${comment_id}`;
     showWindowForComment(url);
+    return;
+  }
+
+  fetch(`${url}`, {
+    method: 'DELETE',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+  })
+  .then((response) => response.json())
+  .then((responseJson) => {
+    if (responseJson.success) {
+      window.location.reload();
+    }
   });
-}
+});
+
+
+// next page of comments is loaded when the end of the list becomes visible
+const moreComments = document.querySelector('#more-comments');
 
-const deleteCommentButtons = document.querySelectorAll('.delete-comment');
+if (moreComments) {
+  let loading = false;
+
+  const observer = new IntersectionObserver((entries) => {
+    if (!entries[0].isIntersecting || loading) {
+      return;
+    }
+    loading = true;
 
-for (button of deleteCommentButtons){
-  button.addEventListener('click', (evt) => {
     const idea_id = location.pathname.split('/')[2];
-    const comment_id = evt.target.parentElement.id;
-    const url = `/comments/${idea_id}/${comment_id}`;
-    fetch(`${url}`, {
-      method: 'DELETE',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-    })
+    fetch(`/ideas/${idea_id}/comments/more?cursor=${encodeURIComponent(moreComments.dataset.cursor)}`)
     .then((response) => response.json())
     .then((responseJson) => {
       if (responseJson.success) {
-        window.location.reload();
+        comments.insertAdjacentHTML('beforeend', responseJson.html);
       }
+      if (responseJson.success && responseJson.next_cursor) {
+        moreComments.dataset.cursor = responseJson.next_cursor;
+        // observe again, so the next page is loaded if the end of the list is still visible
+        observer.unobserve(moreComments);
+        observer.observe(moreComments);
+      }
+      else {
+        observer.disconnect();
+        moreComments.remove();
+      }
+      loading = false;
     });
   });
+
+  observer.observe(moreComments);
 }
 
 function handleComment(method, idea_id, description, comment_id) {
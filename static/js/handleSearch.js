@@ -1,40 +1,114 @@
 const filterForm = document.querySelector('#filter');
-
 const sortSelect = document.querySelector('#sort');
+const perpageSelect = document.querySelector('#perpage');
+const searchInput = filterForm.querySelector('input[name="search"]');
+const ideasTable = document.querySelector('#ideas');
+const pageLinks = document.querySelector('#pages');
 
-sortSelect.addEventListener('change', (evt) => {
-// when sorting is changed, initiate submit of the search form
+// pages are found by cursor, unless the page was opened with a page number
+let pagedByNumber = document.querySelector('#page') !== null;
 
-  filterForm.submit();
-});
+const ideaRow = (idea) => {
+  // a row of the ideas table, like the rows rendered by ideas.html
+  let vote = '';
+  if (ideasTable.dataset.loggedIn === 'true') {
+    const color = (idea.user_vote === 1 ? 'green' : 'lightgray');
+    vote = `<a href="#" class='vote ${idea.idea_id}'><i class="fas fa-check-circle" style="font-size:24px; color: ${color}"></i></a>`;
+  }
 
-const perpageSelect = document.querySelector('#perpage');
+  const row = document.createElement('tr');
+  row.innerHTML = `
+    <td><a href="/ideas/${idea.idea_id}/comments" class="idea-link"></a></td>
+    <td>${vote} <span class='total-votes ${idea.idea_id}'>${idea.total_votes}</span> votes</td>
+    <td class="d-none d-sm-table-cell">${idea.modified}</td>`;
+  // title is set as text, so it can't add html to the page
+  row.querySelector('.idea-link').textContent = idea.title;
 
-perpageSelect.addEventListener('change', (evt) => {
-// when per page is changed, initiate submit of the search form
+  return row;
+};
 
-  filterForm.submit();  
-});
+const pageLink = (text, attribute, value) => {
+  // a link to another page or just the text if there is no such page
+  if (value === null || value === undefined) {
+    return text;
+  }
+  return `<a href="#" ${attribute}="${value}">${text}</a>`;
+};
+
+const showPageLinks = (responseJson) => {
+  if (responseJson.pages === null) {
+    pageLinks.innerHTML = [
+      pageLink(' First ', 'data-cursor', ''),
+      pageLink('&lt;&lt; Previous ', 'data-cursor', responseJson.prev_cursor),
+      pageLink('Next &gt;&gt;', 'data-cursor', responseJson.next_cursor),
+    ].join(' | ');
+  }
+  else {
+    pageLinks.innerHTML = [
+      pageLink(' First ', 'data-page', 1),
+      pageLink('&lt;&lt; Previous ', 'data-page', responseJson.prev_num),
+      pageLink('Next &gt;&gt;', 'data-page', responseJson.next_num),
+      pageLink(' Last ', 'data-page', responseJson.pages > 1 ? responseJson.pages : null),
+    ].join(' | ');
+  }
+};
 
-const pageLinks = document.querySelectorAll('.page');
+const loadIdeas = (position) => {
+  // get the ideas on the page at position ({cursor: ...} or {page: ...}) and show them without reloading the page
+  pagedByNumber = ('page' in position);
 
-for (const pageLink of pageLinks) {
-  pageLink.addEventListener('click', (evt) => {
-  // when first, previous, next, or last is clicked, initiate submit of the search form
+  const params = new URLSearchParams({
+    search: searchInput.value,
+    sort: sortSelect.value,
+    perpage: perpageSelect.value,
+    ...position,
+  });
 
-    evt.preventDefault();
-    const page = document.querySelector('#page');
-    page.value = pageLink.classList[1];
-    filterForm.submit();
+  fetch(`${filterForm.dataset.apiUrl}?${params}`)
+  .then((response) => response.json())
+  .then((responseJson) => {
+    if (responseJson.success) {
+      ideasTable.replaceChildren(...responseJson.ideas.map(ideaRow));
+      showPageLinks(responseJson);
+      // the address of the page shows the same ideas if it's reloaded or shared
+      history.replaceState(null, '', `${filterForm.getAttribute('action')}?${params}`);
+    }
+    else {
+      alert(responseJson.message);
+    }
   });
-}
+};
+
+const loadFirstPage = () => {
+  loadIdeas(pagedByNumber ? {page: 1} : {cursor: ''});
+};
+
+// when sorting or number of ideas per page is changed, show the first page
+sortSelect.addEventListener('change', loadFirstPage);
+perpageSelect.addEventListener('change', loadFirstPage);
+
+pageLinks.addEventListener('click', (evt) => {
+  // when first, previous, next, or last is clicked, show that page
+  const link = evt.target.closest('a');
+  if (!link) {
+    return;
+  }
+
+  evt.preventDefault();
+  if ('cursor' in link.dataset) {
+    loadIdeas({cursor: link.dataset.cursor});
+  }
+  else {
+    loadIdeas({page: link.dataset.page});
+  }
+});
 
 const searchButton = document.querySelector('#search');
 
 searchButton.addEventListener('click', (evt) => {
-// when first, previous, next, or last is clicked, initiate submit of the search form
+// when search is clicked, show the most relevant ideas first
 
   evt.preventDefault();
   sortSelect.value = "relevance";
-  filterForm.submit();
+  loadFirstPage();
 });
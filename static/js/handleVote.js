@@ -1,51 +1,50 @@
-const voteLinks = document.querySelectorAll('.vote');
+// votes are handled for the whole page, so votes of ideas shown later without reloading the page work too
+document.addEventListener('click', (evt) => {
+  const voteLink = evt.target.closest('.vote');
+  if (!voteLink) {
+    return;
+  }
 
-for (const voteLink of voteLinks){
-  voteLink.addEventListener('click', (evt) => { 
-    // go through all inputs and check if its filled out
-    evt.preventDefault();
-    vote = evt.target;
+  evt.preventDefault();
+  const vote = voteLink.querySelector('i');
 
-    const voteJSON = {
-      idea_id: vote.parentElement.classList[1],
-    };
-    
-    console.log(voteJSON);
+  // the server returns the number of votes after the change, so repeated clicks and votes of other users are shown right
+  const voteJSON = {
+    idea_id: voteLink.classList[1],
+  };
 
-    if (vote.style.color === "lightgray") {
-      fetch('/votes', {
-        method: 'POST',
-        body: JSON.stringify(voteJSON),
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      })
-      .then((response) => response.json())
-      .then((responseJson) => {
-        if (responseJson.success) {
-          vote.style.color = "green";
-          const voteTotal = document.getElementsByClassName(`total-votes ${voteJSON.idea_id}`)[0];
-          voteTotal.innerText = 1 + parseInt(voteTotal.innerText);
-        }
-      });
-    }
-    else {
-      fetch('/votes', {
-        method: 'DELETE',
-        body: JSON.stringify(voteJSON),
-        headers: {
-          'Content-Type': 'application/json',
-        },
-      })
-      .then((response) => response.json())
-      .then((responseJson) => {
-        if (responseJson.success) {
-          vote.style.color = "lightgray";
-          const voteTotal = document.getElementsByClassName(`total-votes ${voteJSON.idea_id}`)[0];
-          voteTotal.innerText = parseInt(voteTotal.innerText) - 1;
-        }
-      });
-    }
-  });
-  
-}
\ No newline at end of file
+  if (vote.style.color === "lightgray") {
+    fetch('/votes', {
+      method: 'POST',
+      body: JSON.stringify(voteJSON),
+      headers: {
+        'Content-Type': 'application/json',
+      },
+    })
+    .then((response) => response.json())
+    .then((responseJson) => {
+      if (responseJson.success) {
+        vote.style.color = "green";
+        const voteTotal = document.getElementsByClassName(`total-votes ${voteJSON.idea_id}`)[0];
+        voteTotal.innerText = responseJson.total_votes;
+      }
+    });
+  }
+  else {
+    fetch('/votes', {
+      method: 'DELETE',
+      body: JSON.stringify(voteJSON),
+      headers: {
+        'Content-Type': 'application/json',
+      },
+    })
+    .then((response) => response.json())
+    .then((responseJson) => {
+      if (responseJson.success) {
+        vote.style.color = "lightgray";
+        const voteTotal = document.getElementsByClassName(`total-votes ${voteJSON.idea_id}`)[0];
+        voteTotal.innerText = responseJson.total_votes;
+      }
+    });
+  }
+});
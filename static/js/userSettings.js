@@ -10,6 +10,7 @@ formUserDetails.addEventListener('submit', (evt) => {
   const user_id = document.querySelector('.user_id').value;
   const username = document.querySelector('#username').value;
   const description = document.querySelector('#description').value;
+  const notificationWindow = parseInt(document.querySelector('#notification-window').value);
   console.log(username, description);
 
   const url = `/users/${user_id}/details`;
@@ -17,6 +18,7 @@ formUserDetails.addEventListener('submit', (evt) => {
   const userDetailsJSON = {
     username: username, 
     description: description,
+    notification_window: notificationWindow,
   };
 
   // create fetch request to update the user
@@ -38,41 +40,66 @@ formUserDetails.addEventListener('submit', (evt) => {
   });
 });
 
+// the password form is not shown to users who only sign in with Google
 const formUserPassword = document.querySelector('#user-password');
 
-formUserPassword.addEventListener('submit', (evt) => {
+if (formUserPassword) {
+  formUserPassword.addEventListener('submit', (evt) => {
+    evt.preventDefault();
+    if (formUserPassword.classList.contains('invalid')){
+      formUserPassword.classList.remove('invalid');
+      return;
+    }
+    
+    const user_id = document.querySelector('.user_id').value;
+    const password = document.querySelector('#password').value;
+    const confirmPassword = document.querySelector('#confirm-password').value;
+
+    const url = `/users/${user_id}/password`;
+    
+    const userPasswordJSON = {
+      password: password, 
+      confirmPassword: confirmPassword,
+    };
+
+    // create fetch request to update the user
+    fetch(url, {
+      method: "PUT",
+      body: JSON.stringify(userPasswordJSON),
+      headers: {
+        'Content-Type': 'application/json',
+      },
+    })
+    .then((response) => response.json())
+    .then((responseJson) => {
+      if (responseJson.success) {
+        window.location.reload();
+      }
+      else if (responseJson.error === 400) {
+        alert(responseJson.message);
+      }
+    });
+  });
+}
+
+const formUserSessions = document.querySelector('#user-sessions');
+
+formUserSessions.addEventListener('submit', (evt) => {
   evt.preventDefault();
-  if (formUserPassword.classList.contains('invalid')){
-    formUserPassword.classList.remove('invalid');
-    return;
-  }
-  
-  const user_id = document.querySelector('.user_id').value;
-  const password = document.querySelector('#password').value;
-  const confirmPassword = document.querySelector('#confirm-password').value;
 
-  const url = `/users/${user_id}/password`;
-  
-  const userPasswordJSON = {
-    password: password, 
-    confirmPassword: confirmPassword,
-  };
+  const user_id = document.querySelector('.user_id').value;
 
-  // create fetch request to update the user
-  fetch(url, {
-    method: "PUT",
-    body: JSON.stringify(userPasswordJSON),
-    headers: {
-      'Content-Type': 'application/json',
-    },
+  // end all sessions of the user, this browser is signed out too
+  fetch(`/users/${user_id}/sessions`, {
+    method: "DELETE",
   })
   .then((response) => response.json())
   .then((responseJson) => {
     if (responseJson.success) {
-      window.location.reload();
+      window.location.href = "/";
     }
     else if (responseJson.error === 400) {
       alert(responseJson.message);
     }
   });
-});
\ No newline at end of file
+});
@@ -1,10 +1,34 @@
 from unittest import TestCase
-from server import app
-from model import connect_to_db, db, User, Idea, Comment, Vote
-from flask import url_for, request, session
+import server
+from server import create_app
+import model
+from model import connect_to_db, db, User, Idea, Comment, Vote, OutboxEmail, CommentNotification, SearchIndexQueue, VoteBuffer
+import crud
+import search_indexer
+import utils
+import smtplib
+import cache
+from cache import search_cache, fragment_cache, user_cache
+import bcrypt
+import passwords
+from flask import url_for, request, session, g
+from sqlalchemy import event
+from contextlib import contextmanager
+from unittest.mock import patch, MagicMock
 from datetime import datetime
 import json
+import base64
+import gzip
 import os
+import time
+
+
+app = create_app({
+    "SECRET_KEY": "key",
+    "EMAIL_CONFIRMATION_SALT": "salt",
+    "SQLALCHEMY_DATABASE_URI": "postgresql:///idea_testdb",
+    "METRICS_TOKEN": "metrics",
+    })
 
 
 class FlaskTestsBasic(TestCase):
@@ -42,6 +66,25 @@ class FlaskTestsBasic(TestCase):
         result = self.client.get("/")
         self.assertIn(b"Lightbulb is a free", result.data)
 
+    def test_request_metrics(self):
+        """Test that finished requests are counted by endpoint and status."""
+
+        headers = {"Authorization": "Bearer metrics"}
+        count = json.loads(self.client.get("/metrics", headers=headers).data)["requests"]["count"]
+        self.client.get("/")
+        self.client.get("/no-such-page")
+
+        metrics = json.loads(self.client.get("/metrics", headers=headers).data)["requests"]
+        self.assertEqual(metrics["count"], count + 3)
+        self.assertGreaterEqual(metrics["endpoints"]["routes.homepage"]["count"], 1)
+        self.assertGreaterEqual(metrics["statuses"]["4xx"], 1)
+
+        # metrics are not shown without the token
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 404)
+        with patch.dict(app.config, {"METRICS_TOKEN": None}):
+            self.assertEqual(self.client.get("/metrics", headers=headers).status_code, 404)
+
     def test_login(self):
         """Test login page."""
 
@@ -52,6 +95,23 @@ class FlaskTestsBasic(TestCase):
         data = json.loads(result.data)
         self.assertEqual(data['success'], True)
 
+    def test_login_rehash(self):
+        """Test that password hashed with another work factor is rehashed on login."""
+
+        user = User.get_by_email("user0@test.com")
+        user.password_hash = bcrypt.hashpw("test0A!!", bcrypt.gensalt(4))
+        db.session.commit()
+
+        result = self.client.post("/login",
+                                  headers={'Content-Type': 'application/json'},
+                                  json={"email": "user0@test.com", "password": "test0A!!"}
+                                  )
+        self.assertEqual(json.loads(result.data)['success'], True)
+
+        user = User.get_by_email("user0@test.com")
+        self.assertFalse(passwords.needs_rehash(user.password_hash))
+        self.assertTrue(user.verify_password("test0A!!"))
+
     def test_logout(self):
         """Test logout route."""
 
@@ -107,7 +167,7 @@ class FlaskTestsDatabase(TestCase):
     def test_ideas_list_latest_sort(self):
         """Test ideas sorting by last modification."""
 
-        ideas = Idea.query.order_by(Idea.modified.desc()).all()
+        ideas = Idea.query.order_by(Idea.modified.desc(), Idea.idea_id.desc()).all()
         result = self.client.get("/all-ideas")
 
         idx = []
@@ -133,6 +193,146 @@ class FlaskTestsDatabase(TestCase):
         self.assertGreater(idx2, -1, f"Strings {idea2.title} should be on the page")
         self.assertLess(idx1, idx2, f"Strings {idea1.title} and {idea2.title} are in the wrong order")
 
+    def test_ideas_list_cursor(self):
+        """Test paging through ideas with cursors."""
+
+        ideas = Idea.query.order_by(Idea.vote_count.desc(), Idea.modified.desc(), Idea.idea_id.desc()).all()
+
+        first_page = crud.get_ideas_with_votes_filtered(None, "", "votes", 1, 4, "")
+        self.assertEqual([idea[0] for idea in first_page.items], ideas[:4])
+        self.assertFalse(first_page.has_prev)
+
+        second_page = crud.get_ideas_with_votes_filtered(None, "", "votes", 1, 4, first_page.next_cursor)
+        self.assertEqual([idea[0] for idea in second_page.items], ideas[4:8])
+
+        previous_page = crud.get_ideas_with_votes_filtered(None, "", "votes", 1, 4, second_page.prev_cursor)
+        self.assertEqual([idea[0] for idea in previous_page.items], ideas[:4])
+        self.assertFalse(previous_page.has_prev)
+
+        result = self.client.get("/all-ideas?sort=votes&cursor=invalid")
+        self.assertEqual(result.status_code, 400)
+
+        # a well-formed cursor with a value that isn't a number
+        cursor = base64.urlsafe_b64encode(json.dumps(["next", ["x", "2021-01-01T00:00:00", 1]]).encode()).decode()
+        result = self.client.get(f"/all-ideas?sort=votes&cursor={cursor}")
+        self.assertEqual(result.status_code, 400)
+        result = self.client.get(f"/api/ideas?search=&sort=votes&perpage=10&cursor={cursor}")
+        self.assertEqual(result.status_code, 400)
+
+    def test_ideas_list_streamed(self):
+        """Test that the search form is sent before the listing query runs."""
+
+        result = self.client.get("/all-ideas?search=&sort=latest&perpage=10&page=1")
+        self.assertTrue(result.is_streamed)
+
+        chunks = iter(result.response)
+        head = b""
+        with query_budget(self, 0):
+            while b'name="search"' not in head:
+                head += next(chunks)
+
+        self.assertIn(Idea.query.get(10).title.encode(), b"".join(chunks))
+        result.close()
+
+    def test_ideas_list_api(self):
+        """Test the JSON page of ideas with its ETag and compression."""
+
+        result = self.client.get("/api/ideas?search=&sort=votes&perpage=4&page=2")
+        data = json.loads(result.data)
+        ideas = Idea.query.order_by(Idea.vote_count.desc(), Idea.modified.desc(), Idea.idea_id.desc()).all()
+
+        self.assertEqual(data['success'], True)
+        self.assertEqual([idea['idea_id'] for idea in data['ideas']], [idea.idea_id for idea in ideas[4:8]])
+        self.assertEqual(data['pages'], 3)
+        self.assertEqual((data['prev_num'], data['next_num']), (1, 3))
+
+        etag = result.headers['ETag']
+        result = self.client.get("/api/ideas?search=&sort=votes&perpage=4&page=2", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+        # pages larger than the listing offers are cut to its largest page
+        with patch.object(server, "MAX_PER_PAGE", 4):
+            result = self.client.get("/api/ideas?search=&sort=votes&perpage=1000000&page=1")
+        self.assertEqual(len(json.loads(result.data)['ideas']), 4)
+
+        result = self.client.get("/api/ideas?search=&sort=votes&perpage=10&cursor=", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+        data = json.loads(gzip.decompress(result.data))
+        self.assertEqual(len(data['ideas']), 10)
+        self.assertIsNone(data['pages'])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_ideas_list_not_modified(self):
+        """Test that anonymous users get 304 for pages that weren't changed since they got them."""
+
+        # a vote for idea 1 in another browser, added and removed by turns
+        for url, change_vote in zip(["/all-ideas?sort=votes", "/ideas/1/comments", "/users/1/ideas"], [Vote.add, Vote.remove, Vote.add]):
+            result = self.client.get(url)
+            etag = result.headers['ETag']
+            self.assertIn('public', result.headers['Cache-Control'])
+            # the listing is streamed, closing it ends the request
+            result.close()
+
+            # only the version stamps are read
+            with query_budget(self, 2):
+                result = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(result.status_code, 304)
+
+            change_vote(1, 1)
+            db.session.commit()
+
+            result = self.client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(result.status_code, 200)
+            result.close()
+
+        # a comment author renamed themselves
+        etag = self.client.get("/ideas/1/comments").headers['ETag']
+        commenter = Comment.query.filter(Comment.idea_id == 1).first().user
+        commenter.username = "renamed"
+        db.session.commit()
+        result = self.client.get("/ideas/1/comments", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+
+        self.assertEqual(self.client.get("/ideas/999/comments").status_code, 404)
+        self.assertEqual(self.client.get("/users/999/ideas").status_code, 404)
+
+        # counts rebuilt by the reconcile job and search text rebuilt by reindex change the listing
+        for url in ["/all-ideas?sort=votes", "/users/1/ideas"]:
+            Idea.query.filter(Idea.idea_id == 1).update({Idea.vote_count: 100})
+            db.session.commit()
+
+            for rebuild in [crud.reconcile_vote_counts, search_indexer.reindex]:
+                result = self.client.get(url)
+                etag = result.headers['ETag']
+                result.close()
+
+                rebuild()
+                db.session.commit()
+
+                result = self.client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(result.status_code, 200)
+                result.close()
+
+    def test_ideas_list_fragment_cache(self):
+        """Test that rendered rows of ideas are reused until the idea or its votes change."""
+
+        url = "/all-ideas?sort=latest&perpage=10&page=1"
+        self.client.get(url).data
+
+        before = fragment_cache.get_metrics()
+        self.client.get(url).data
+        after = fragment_cache.get_metrics()
+        self.assertEqual((after["hits"] - before["hits"], after["misses"] - before["misses"]), (10, 0))
+
+        Vote.add(1, 1)
+        db.session.commit()
+
+        before = fragment_cache.get_metrics()
+        data = self.client.get(url).data
+        after = fragment_cache.get_metrics()
+        self.assertEqual((after["hits"] - before["hits"], after["misses"] - before["misses"]), (9, 1))
+        self.assertIn(b"<span class='total-votes 1'>3</span>", data)
+
     def test_ideas_list_search(self):
         """Test ideas searching."""
 
@@ -150,6 +350,21 @@ class FlaskTestsDatabase(TestCase):
         self.assertLess(idx1, idx2, f"Strings {idea1.title} and {idea2.title} are in the wrong order")
         self.assertEqual(num_ideas, 2, "Wrong amount of ideas")
 
+    def test_ideas_list_relevance(self):
+        """Test that ideas with search words in the title are more relevant than ideas with these words in the description."""
+
+        title_idea = Idea.query.get(8)
+        title_idea.title = "Via Zeppelin"
+        description_idea = Idea.query.get(2)
+        description_idea.description = "Zeppelin zeppelin " + description_idea.description
+        db.session.commit()
+        SearchIndexQueue.index_pending()
+        db.session.commit()
+
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(None, "zeppelin", "relevance", 1, 10)
+
+        self.assertEqual([idea[0].idea_id for idea in ideas_with_votes.items], [8, 2])
+
     def test_idea_comments(self):
         """Test idea comments."""
 
@@ -157,6 +372,58 @@ class FlaskTestsDatabase(TestCase):
         
         self.assertIn(b'would like to have this app', result.data)
 
+    def test_idea_comments_pages(self):
+        """Test that the idea page shows the first page of comments and the rest are loaded by cursor."""
+
+        user = User.get_by_id(3)
+        db.session.add_all([Comment(user=user, idea_id=1, description=f"comment {n}.", modified=datetime(2022, 5, 1, 0, n)) for n in range(25)])
+        db.session.commit()
+
+        result = self.client.get("/ideas/1/comments")
+        self.assertIn(b'comment 24.', result.data)
+        self.assertIn(b'comment 5.', result.data)
+        self.assertNotIn(b'comment 4.', result.data)
+        self.assertIn(b'id="more-comments"', result.data)
+
+        cursor = crud.get_comments_page(1, "", 20).next_cursor
+        result = self.client.get(f"/ideas/1/comments/more?cursor={cursor}")
+        data = json.loads(result.data)
+        self.assertEqual(data['success'], True)
+        self.assertIn('comment 4.', data['html'])
+        self.assertIn('comment 0.', data['html'])
+        self.assertNotIn('comment 5.', data['html'])
+        self.assertIsNone(data['next_cursor'])
+
+        result = self.client.get("/ideas/1/comments/more?cursor=wrong")
+        self.assertEqual(result.status_code, 400)
+
+    def test_engine_options(self):
+        """Test that connections have a statement timeout and the pool is configured."""
+
+        timeout = db.session.execute(
+            "SELECT extract(epoch FROM current_setting('statement_timeout')::interval) * 1000").scalar()
+        self.assertEqual(timeout, model.statement_timeout)
+        self.assertEqual(db.engine.pool.size(), model.pool_size)
+        self.assertFalse(db.engine.echo)
+
+    def test_query_budget(self):
+        """Test that pages run a fixed number of queries however many comments and ideas they show."""
+
+        users = [User(username=f"commenter{n}", email=f"commenter{n}@test.com", password="test0A!!") for n in range(10)]
+        db.session.add_all([Comment(user=user, idea_id=1, description="me too", modified=datetime.now()) for user in users])
+        db.session.commit()
+
+        # idea with its author, comments with their authors, votes of the idea
+        with query_budget(self, 3):
+            result = self.client.get("/ideas/1/comments")
+        self.assertEqual(result.data.count(b'me too'), 10)
+
+        # version stamps of the ETag, page of ideas and number of all ideas. The stamps are read before the page 
+        # so a browser that has the page gets 304 after this one query, they can't be folded into the page query, 
+        # which runs while the streamed body is read and is skipped when the page is in the search cache
+        with query_budget(self, 3):
+            self.client.get("/all-ideas?search=&sort=votes&perpage=10&page=1").data
+
 
 class FlaskTestsLoggedIn(TestCase):
     """Flask tests with user logged in to session."""
@@ -186,6 +453,15 @@ class FlaskTestsLoggedIn(TestCase):
         db.drop_all()
         db.engine.dispose()
 
+    def test_ideas_list_private(self):
+        """Test that pages of logged in users are not cached for other users."""
+
+        result = self.client.get("/all-ideas")
+
+        self.assertNotIn('ETag', result.headers)
+        self.assertIn('private', result.headers['Cache-Control'])
+        result.close()
+
     def test_create_idea(self):
         """Test creating an idea."""
 
@@ -230,6 +506,53 @@ class FlaskTestsLoggedIn(TestCase):
         self.assertEqual(idea.link, "https://github.com/test/test")
         self.assertEqual(idea.image, "/static/img/idea3.png")
 
+    def test_ideas_list_search_cache(self):
+        """Test that repeated searches are read from the cache until an idea is changed."""
+
+        first = crud.get_ideas_with_votes_filtered(None, "information time", "latest", 1, 10)
+        hits = search_cache.get_metrics()["hits"]
+        second = crud.get_ideas_with_votes_filtered(None, "Time  INFORMATION", "latest", 1, 10)
+
+        self.assertEqual(search_cache.get_metrics()["hits"], hits + 1)
+        self.assertEqual([idea[0].idea_id for idea in second.items], [idea[0].idea_id for idea in first.items])
+        self.assertEqual(second.total, first.total)
+
+        Idea.update(3, "Zeppelin", "Test", "", "")
+        db.session.commit()
+        # searched before the indexer makes the new title searchable
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(None, "zeppelin", "latest", 1, 10)
+        self.assertEqual(ideas_with_votes.items, [])
+
+        # the indexer bumps no counter of this process, the key changes with the version stamps in the database
+        SearchIndexQueue.index_pending()
+        db.session.commit()
+
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(None, "information time", "latest", 1, 10)
+        self.assertEqual(search_cache.get_metrics()["hits"], hits + 1)
+        self.assertNotIn(3, [idea[0].idea_id for idea in ideas_with_votes.items])
+
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(None, "zeppelin", "latest", 1, 10)
+        self.assertEqual(search_cache.get_metrics()["hits"], hits + 1)
+        self.assertEqual([idea[0].idea_id for idea in ideas_with_votes.items], [3])
+
+    def test_update_idea_search_index(self):
+        """Test that an updated idea is searchable by its new title after the queue is indexed."""
+
+        self.client.put("/ideas/1",
+                        headers={'Content-Type': 'application/json'},
+                        json={"title": "Zeppelin", "description": "Test", "link": "", "image": "",}
+                        )
+
+        self.assertIsNotNone(SearchIndexQueue.query.get(1))
+        self.assertEqual(crud.get_ideas_with_votes_filtered(None, "zeppelin", "latest", 1, 10).items, [])
+
+        SearchIndexQueue.index_pending()
+        db.session.commit()
+
+        self.assertIsNone(SearchIndexQueue.query.get(1))
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(None, "zeppelin", "latest", 1, 10)
+        self.assertEqual([idea[0].idea_id for idea in ideas_with_votes.items], [1])
+
     def test_create_comment(self):
         """Test creating a comment."""
 
@@ -248,6 +571,39 @@ class FlaskTestsLoggedIn(TestCase):
 
         self.assertEqual(comment.description, "Would be a very useful app for HB students")
 
+        notification = CommentNotification.query.filter(CommentNotification.comment_id == comment_id).one()
+        self.assertEqual(notification.user_id, 1)
+
+    def test_comment_notification_digest(self):
+        """Test that comments to an idea are sent to its owner in one email."""
+
+        User.query.get(1).notification_window = 0
+        db.session.commit()
+
+        for description in ["First comment", "Second comment", "Third comment"]:
+            result = self.client.post("/comments/1",
+                                      headers={'Content-Type': 'application/json'},
+                                      json={"description": description}
+                                      )
+        comment_id = json.loads(result.data)["added"]
+
+        # updated comment replaces the notification about its first version
+        self.client.put(f"/comments/1/{comment_id}",
+                        headers={'Content-Type': 'application/json'},
+                        json={"description": "Updated third comment"}
+                        )
+
+        # digests are rendered from templates, leaving the app context removes the session, so commit inside it
+        with app.app_context():
+            self.assertEqual(CommentNotification.queue_digests(), 1)
+            db.session.commit()
+
+            email = OutboxEmail.query.filter(OutboxEmail.receiver_email == "user0@test.com").one()
+            self.assertIn("First comment", email.html)
+            self.assertIn("Updated third comment", email.html)
+            self.assertEqual(email.html.count("third comment"), 1)
+            self.assertEqual(CommentNotification.query.count(), 0)
+
     def test_update_comment(self):
         """Test updating a comment."""
 
@@ -313,6 +669,131 @@ class FlaskTestsLoggedIn(TestCase):
 
         self.assertEqual(Vote.query.get(vote_id), None)
 
+    def test_vote_count(self):
+        """Test that voting and unvoting update the number of votes of an idea."""
+
+        self.client.post("/votes",
+                          headers={'Content-Type': 'application/json'},
+                          json={"idea_id": "5"}
+                          )
+        self.assertEqual(Idea.query.get(5).vote_count, 2)
+
+        self.client.delete("/votes",
+                          headers={'Content-Type': 'application/json'},
+                          json={"idea_id": "5"}
+                          )
+        self.assertEqual(Idea.query.get(5).vote_count, 1)
+
+    def test_vote_repeated(self):
+        """Test that voting twice or unvoting an idea the user didn't vote for counts nothing."""
+
+        for n in range(2):
+            result = self.client.post("/votes",
+                                      headers={'Content-Type': 'application/json'},
+                                      json={"idea_id": "5"}
+                                      )
+            data = json.loads(result.data)
+            self.assertEqual(data['success'], True)
+            self.assertEqual(data['total_votes'], 2)
+        self.assertIsNone(data['added'])
+        self.assertEqual(Idea.query.get(5).vote_count, 2)
+
+        for n in range(2):
+            result = self.client.delete("/votes",
+                                        headers={'Content-Type': 'application/json'},
+                                        json={"idea_id": "5"}
+                                        )
+            data = json.loads(result.data)
+            self.assertEqual(data['success'], True)
+            self.assertEqual(data['total_votes'], 1)
+        self.assertIsNone(data['deleted'])
+        self.assertEqual(Idea.query.get(5).vote_count, 1)
+
+    def test_vote_invalid_idea(self):
+        """Test that a vote without an idea is rejected and a vote for an idea that doesn't exist is not found."""
+
+        for buffered in [False, True]:
+            server.BUFFER_VOTES = buffered
+            try:
+                for method in [self.client.post, self.client.delete]:
+                    for body in [{}, {"idea_id": None}, {"idea_id": "five"}]:
+                        result = method("/votes", headers={'Content-Type': 'application/json'}, json=body)
+                        self.assertEqual(result.status_code, 400)
+
+                    result = method("/votes", headers={'Content-Type': 'application/json'}, json={"idea_id": 999})
+                    self.assertEqual(result.status_code, 404)
+            finally:
+                server.BUFFER_VOTES = False
+
+        self.assertEqual(VoteBuffer.query.count(), 0)
+
+    def test_vote_buffer(self):
+        """Test that buffered votes are written in a batch and only the last change of a user is counted."""
+
+        server.BUFFER_VOTES = True
+        try:
+            for method in [self.client.post, self.client.delete, self.client.post]:
+                result = method("/votes",
+                                headers={'Content-Type': 'application/json'},
+                                json={"idea_id": "5"}
+                                )
+            self.assertEqual(json.loads(result.data)['total_votes'], 2)
+            self.assertEqual(Idea.query.get(5).vote_count, 1)
+
+            self.assertEqual(VoteBuffer.write_pending(), 1)
+            db.session.commit()
+            self.assertEqual(Idea.query.get(5).vote_count, 2)
+            self.assertIsNotNone(Vote.query.filter_by(user_id=1, idea_id=5).first())
+
+            # a change that repeats what is already written counts nothing
+            self.client.post("/votes",
+                             headers={'Content-Type': 'application/json'},
+                             json={"idea_id": "5"}
+                             )
+            VoteBuffer.write_pending()
+            db.session.commit()
+            self.assertEqual(Idea.query.get(5).vote_count, 2)
+            self.assertEqual(VoteBuffer.query.count(), 0)
+        finally:
+            server.BUFFER_VOTES = False
+
+    def test_read_replica_routing(self):
+        """Test that read-only pages read from a replica until the user changes something."""
+
+        app.config['SQLALCHEMY_BINDS'] = {"replica_0": "postgresql:///idea_testdb"}
+        db.session.remove()
+        try:
+            with app.test_request_context():
+                g.read_only = True
+                self.assertIs(db.session.get_bind(), db.get_engine(app, bind="replica_0"))
+                # pages stored in the search cache are read from the primary
+                with model.read_from_primary():
+                    self.assertIs(db.session.get_bind(), db.engine)
+                g.read_only = False
+                self.assertIs(db.session.get_bind(), db.engine)
+            db.session.remove()
+
+            self.client.get("/all-ideas").data
+            with self.client.session_transaction() as sess:
+                self.assertNotIn('primary_until', sess)
+
+            self.client.post("/votes",
+                              headers={'Content-Type': 'application/json'},
+                              json={"idea_id": "5"}
+                              )
+            with self.client.session_transaction() as sess:
+                self.assertGreater(sess['primary_until'], time.time())
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = {}
+
+    def test_ideas_list_user_votes(self):
+        """Test marking ideas the logged in user voted for."""
+
+        ideas_with_votes = crud.get_ideas_with_votes_filtered(1, "", "latest", 1, 10)
+        voted_idea_ids = {idea[0].idea_id for idea in ideas_with_votes.items if idea.user_vote == 1}
+
+        self.assertEqual(voted_idea_ids, {9, 10})
+
     def test_update_user_details(self):
         """Test updating user details."""
 
@@ -345,6 +826,42 @@ class FlaskTestsLoggedIn(TestCase):
         data = json.loads(result.data)
         self.assertEqual(data['success'], True)
 
+    def test_user_cache(self):
+        """Test that the signed in user is cached between requests in a shared cache until the user is changed."""
+
+        # without a shared cache a change in one process wouldn't reach the others
+        if not cache.cache_url:
+            self.assertFalse(user_cache.enabled)
+
+        # a cache in the test process works as a cache shared by all processes
+        with patch.object(user_cache, "backend", cache.MemoryCache(10, 60)), patch.object(user_cache, "enabled", True):
+            User.get_cached(1)
+            db.session.remove()
+            with query_budget(self, 0):
+                user = User.get_cached(1)
+            self.assertEqual(user.user_id, 1)
+
+            User.update_details(1, "superuser", "changed")
+            db.session.commit()
+            db.session.remove()
+            self.assertEqual(User.get_cached(1).username, "superuser")
+
+    def test_revoke_sessions(self):
+        """Test that signing out in all browsers ends sessions of the user in other browsers."""
+
+        other_browser = app.test_client()
+        with other_browser.session_transaction() as sess:
+            sess['user_id'] = 1
+
+        result = self.client.delete("/users/1/sessions")
+        self.assertEqual(json.loads(result.data)['success'], True)
+
+        with other_browser.session_transaction() as sess:
+            self.assertNotIn('user_id', sess)
+        with self.client.session_transaction() as sess:
+            self.assertNotIn('user_id', sess)
+
+
 class FlaskTestsLoggedOut(TestCase):
     """Flask tests with user logged out from session."""
 
@@ -496,6 +1013,71 @@ class FlaskTestsLoggedOut(TestCase):
         self.assertEqual(data['message'], 'User did not login to the application.')
 
 
+class EmailTests(TestCase):
+    """Tests of sending emails over pooled SMTP connections, the SMTP server is mocked."""
+
+    emails = [("text", "<p>html</p>", "Subject", "first@test.com"), ("text", "<p>html</p>", "Subject", "second@test.com")]
+
+    def setUp(self):
+        """Send over a new pool to a server without SSL and login."""
+
+        for patcher in [patch.object(utils, "smtp_pool", utils.SMTPConnectionPool()),
+                        patch.object(utils, "use_ssl", False),
+                        patch.dict(os.environ, {"NOTIFICATION_PASSWORD": ""})]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_connection_reused(self):
+        """Test that batches of emails are sent over the same connection."""
+
+        with patch("utils.smtplib.SMTP") as smtp:
+            self.assertEqual(utils.send_emails(self.emails), [None, None])
+            self.assertEqual(utils.send_emails(self.emails[:1]), [None])
+
+        smtp.assert_called_once()
+        self.assertEqual(smtp.return_value.sendmail.call_count, 3)
+
+    def test_retry_disconnected(self):
+        """Test that emails are sent over a new connection if the server closed the connection."""
+
+        closed, opened = MagicMock(), MagicMock()
+        closed.sendmail.side_effect = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+        with patch("utils.smtplib.SMTP", side_effect=[closed, opened]):
+            self.assertEqual(utils.send_emails(self.emails), [None, None])
+
+        self.assertEqual(opened.sendmail.call_count, 2)
+
+    def test_give_up_disconnected(self):
+        """Test that emails fail with the error if the server closes the new connection too."""
+
+        error = smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        with patch("utils.smtplib.SMTP") as smtp:
+            smtp.return_value.sendmail.side_effect = error
+            self.assertEqual(utils.send_emails(self.emails), [error, error])
+
+        self.assertEqual(smtp.call_count, 2)
+        self.assertEqual(utils.smtp_pool._idle, [])
+
+
+@contextmanager
+def query_budget(test, max_queries):
+    """Fail the test if the code inside the block runs more than max_queries queries."""
+
+    statements = []
+
+    def count_query(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count_query)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_query)
+
+    test.assertLessEqual(len(statements), max_queries, "\n\n".join(statements))
+
+
 def example_data():
     """Create some sample data."""
 
@@ -567,6 +1149,13 @@ def example_data():
     # push all data to db
     db.session.commit()
 
+    # count created votes for every idea
+    crud.reconcile_vote_counts()
+
+    # make ideas searchable
+    SearchIndexQueue.index_pending()
+    db.session.commit()
+
 if __name__ == "__main__":
     import unittest
 
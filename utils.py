@@ -3,35 +3,124 @@ import smtplib, ssl
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from itsdangerous import URLSafeTimedSerializer
-from flask import render_template, url_for
+from flask import render_template, url_for, current_app
+from model import OutboxEmail
+from contextlib import contextmanager
+import threading
+import atexit
+import time
 
 import os
 
-port = 465  # For SSL
-smtp_server = "smtp.gmail.com"
+port = int(os.environ.get('SMTP_PORT', 465))  # 465 for SSL
+smtp_server = os.environ.get('SMTP_SERVER', "smtp.gmail.com")
+# SMTP_USE_SSL=false and empty NOTIFICATION_PASSWORD allow to use a local test server, 
+# for example: python3 -m aiosmtpd -n -l localhost:8025
+use_ssl = os.environ.get('SMTP_USE_SSL', 'true').lower() != 'false'
 sender_email = "lightbulb.shondy@gmail.com"
-password = os.environ['NOTIFICATION_PASSWORD']
-salt = os.environ['EMAIL_CONFIRMATION_SALT']
+
+
+class SMTPConnectionPool:
+    """Logged in SMTP connections that are reused for many emails 
+    instead of connecting and logging in for every email."""
+
+    def __init__(self, max_connections=2, idle_timeout=60):
+        # connections that weren't used for idle_timeout seconds are probably closed by the server
+        self.idle_timeout = idle_timeout
+        self._available = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._context = None
+
+    def _connect(self):
+        if use_ssl:
+            if self._context is None:
+                self._context = ssl.create_default_context()
+            server = smtplib.SMTP_SSL(smtp_server, port, context=self._context, timeout=30)
+        else:
+            server = smtplib.SMTP(smtp_server, port, timeout=30)
+
+        # the password is read when the first connection is opened, so only the mail worker needs it
+        password = os.environ['NOTIFICATION_PASSWORD']
+        if password:
+            server.login(sender_email, password)
+
+        return server
+
+    def _get_idle(self):
+        """Return the most recently used idle connection that hasn't timed out, or None."""
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                server, last_used = self._idle.pop()
+
+            if time.monotonic() - last_used < self.idle_timeout:
+                return server
+
+            close_connection(server)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waits if max_connections connections are already in use."""
+
+        with self._available:
+            server = self._get_idle() or self._connect()
+            try:
+                yield server
+            except Exception:
+                # the connection may be broken, don't give it to anyone else
+                close_connection(server)
+                raise
+            else:
+                with self._lock:
+                    self._idle.append((server, time.monotonic()))
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for server, last_used in idle:
+            close_connection(server)
+
+
+def close_connection(server):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+smtp_pool = SMTPConnectionPool(
+    max_connections=int(os.environ.get('SMTP_MAX_CONNECTIONS', 2)),
+    idle_timeout=int(os.environ.get('SMTP_IDLE_TIMEOUT', 60)))
+
+atexit.register(smtp_pool.close)
 
 
 def send_confirmation_email(user_email):
-    """"create a email for email confirmation"""
+    """"create a email for email confirmation and queue it in the outbox, 
+    it's sent only if the rest of the transaction is committed"""
     # secret_key - to sign and verify with, 
     # salt – extra key to combine with secret_key to distinguish signatures in different contexts.
     # serializer – an object that provides dumps and loads methods for serializing data to a string.
 
-    confirm_serializer = URLSafeTimedSerializer(os.environ['APP_SECRET_KEY'])
+    confirm_serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+    salt = current_app.config['EMAIL_CONFIRMATION_SALT']
 
     # generate absolute url for confirmation
-    confirm_url = url_for('confirm_email', token=confirm_serializer.dumps(user_email, salt=salt), _external=True)
+    confirm_url = url_for('routes.confirm_email', token=confirm_serializer.dumps(user_email, salt=salt), _external=True)
     
     text = f"Your account on Lightbulb app was successfully created. Please click the link below to confirm your email address and activate your account: {confirm_url}"
     html = render_template('email_confirmation.html', confirm_url=confirm_url)
     
-    send_email(text, html, 'Confirm Your Email Address', user_email)
+    OutboxEmail.create(text, html, 'Confirm Your Email Address', user_email)
 
-def send_email(text, html, subject, receiver_email):
-    # send an email from sender_email to receiver_email with subject and body equils to text/html
+def create_message(text, html, subject, receiver_email):
+    # create an email from sender_email to receiver_email with subject and body equils to text/html
 
     message = MIMEMultipart("alternative")
 
@@ -48,8 +137,44 @@ def send_email(text, html, subject, receiver_email):
     message.attach(part1)
     message.attach(part2)
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-        server.login(sender_email, password)
-        server.sendmail(sender_email, receiver_email, message.as_string())
+    return message
+
+def send_emails(emails):
+    """Send emails given as (text, html, subject, receiver_email) over one pooled connection.
+    Return a list with None for every sent email and an error for every email that wasn't sent."""
+
+    errors = []
+    if not emails:
+        return errors
+
+    # if a reused connection was closed by the server, try once more with a new one
+    for attempt in range(2):
+        try:
+            with smtp_pool.connection() as server:
+                for text, html, subject, receiver_email in emails[len(errors):]:
+                    message = create_message(text, html, subject, receiver_email)
+                    try:
+                        server.sendmail(sender_email, receiver_email, message.as_string())
+                        errors.append(None)
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as err:
+                        # only this email was refused, the connection can be used for the next one
+                        errors.append(err)
+            break
+        except smtplib.SMTPServerDisconnected as err:
+            error = err
+        except (smtplib.SMTPException, OSError) as err:
+            error = err
+            break
+
+    if len(errors) < len(emails):
+        # the connection failed, emails that weren't sent yet failed with it
+        errors += [error] * (len(emails) - len(errors))
+
+    return errors
+
+def send_email(text, html, subject, receiver_email):
+    # send an email from sender_email to receiver_email with subject and body equils to text/html
 
+    error = send_emails([(text, html, subject, receiver_email)])[0]
+    if error is not None:
+        raise error
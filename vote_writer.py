@@ -0,0 +1,41 @@
+"""Worker that writes buffered votes to the votes table and the vote counters, when VOTE_BUFFER is on.
+
+    python3 vote_writer.py
+
+Votes left in the buffer when the worker or the database stopped are written when the worker starts again.
+"""
+
+import time
+from sqlalchemy import exc
+
+import model
+import server
+
+
+BATCH_SIZE = 1000
+# seconds to wait for new votes when the buffer is empty, votes show up in listings at most this late
+POLL_INTERVAL = 1
+
+
+def run():
+    """Write buffered votes until the worker is stopped. Every batch is written in one transaction."""
+
+    while True:
+        try:
+            taken = model.VoteBuffer.write_pending(BATCH_SIZE)
+            model.db.session.commit()
+        except exc.SQLAlchemyError as err:
+            model.db.session.rollback()
+            print("Cannot write votes:", err)
+            taken = 0
+
+        # if the batch was full there are probably more votes waiting
+        if taken < BATCH_SIZE:
+            time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    app = server.create_app()
+
+    with app.app_context():
+        run()
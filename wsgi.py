@@ -0,0 +1,9 @@
+"""Entry point of production WSGI servers:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from server import create_app
+
+
+app = create_app()